@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+from . import cli
 from . import models
 from . import controllers
+from . import wizard
 from odoo import api, SUPERUSER_ID
 
 from odoo.addons.payment import setup_provider, reset_payment_provider
 
 
 def post_init_hook(env):
+    # The default countries are only set at installation, so that updating the module keeps the
+    # configured ones. They are set before the provider is copied to the other companies.
+    env.ref('payment_wipay.payment_provider_payway').available_country_ids = env.ref('base.tt')
+    env.ref('payment_wipay.payment_method_wipay').supported_country_ids = (
+        env.ref('base.tt') | env.ref('base.bb') | env.ref('base.jm')
+    )
     setup_provider(env, 'wipay')
 
 
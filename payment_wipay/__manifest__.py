@@ -10,9 +10,15 @@
     'data': [
         'security/ir.model.access.csv',
         'views/payment_wipay_templates.xml',
+        'views/payment_wipay_settlement_views.xml',
+        'wizard/payment_wipay_settlement_import_views.xml',
         'views/payment_provider_views.xml',
+        'views/payment_transaction_views.xml',
         'data/payment_method_data.xml',
+        'data/payment_wipay_endpoint_data.xml',
         'data/payment_provider_data.xml',
+        'data/ir_cron_data.xml',
+        'data/ir_sequence_data.xml',
 
     ],
     'application': False,
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import optparse
+import sys
+from pathlib import Path
+
+from odoo import SUPERUSER_ID, api
+from odoo.cli import Command
+from odoo.modules.registry import Registry
+from odoo.tools import config
+
+
+class WipayReplay(Command):
+    """ Replay WiPay webhook notifications from a JSON Lines export """
+    name = 'wipay_replay'
+
+    def run(self, args):
+        parser = config.parser
+        parser.prog = f'{Path(sys.argv[0]).name} {self.name}'
+        group = optparse.OptionGroup(
+            parser, "WiPay Replay",
+            "Apply the WiPay notifications of a JSON Lines file (one payload per line) to the "
+            "database specified by the `-d` argument.",
+        )
+        group.add_option('--file', dest='wipay_replay_file', help="The JSON Lines file to replay.")
+        group.add_option(
+            '--chunk-size', dest='wipay_replay_chunk_size', type='int', default=500,
+            help="The number of notifications applied per transaction.",
+        )
+        parser.add_option_group(group)
+        opt = config.parse_config(args)
+
+        dbname = config['db_name']
+        if not dbname or not opt.wipay_replay_file:
+            sys.exit("Both a database (-d) and a file (--file) are required.")
+
+        registry = Registry(dbname)
+        with open(opt.wipay_replay_file, encoding='utf-8') as stream, registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            summary = env['payment.wipay.notification']._replay(
+                stream, chunk_size=opt.wipay_replay_chunk_size
+            )
+        print(  # noqa: T201
+            "read %(read)s, applied %(applied)s, invalid signature %(invalid)s, "
+            "errors %(errors)s" % summary
+        )
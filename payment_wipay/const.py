@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# The paths of the WiPay API endpoints, relative to the host of the provider's API URL. Only the
+# request endpoint is part of the published Payments API (v1.0.7); the status and refund endpoints
+# must be enabled on the WiPay account of the merchant.
+API_ENDPOINTS = {
+    'request': '/plugins/payments/request',
+    'status': '/plugins/payments/status',
+    'refund': '/plugins/payments/refund',
+}
+
+# The default token-bucket rate limits of the public routes, as (burst, refills per minute) tuples.
+# They can be overridden with the `payment_wipay.rate_limit.<route>` system parameters, set to
+# "<burst>/<refills per minute>", or to 0 to disable the limit of the route. The webhook limit only
+# applies to the notifications that match no WiPay transaction.
+RATE_LIMITS = {
+    'pay': (10, 30),
+    'prefetch': (10, 30),
+    'return': (20, 60),
+    'webhook': (300, 1200),
+}
+
+# The values of the feature support fields of WiPay providers.
+FEATURE_SUPPORT = {
+    'support_manual_capture': False,
+    'support_refund': 'partial',
+    'support_tokenization': False,
+}
+
+# The WiPay regions, as `payment.wipay.endpoint` regions, that can process each WiPay currency. The
+# first region is the default one.
+CURRENCY_REGIONS = {
+    'TTD': ('tt',),
+    'JMD': ('jm',),
+    'USD': ('tt', 'jm'),
+}
+
+# The prefix of the references of the transactions created by the pay route without a custom prefix.
+PAY_REFERENCE_PREFIX = 'WIPAY'
+
+# The maximum length of the custom prefixes of the references of the pay route.
+PAY_REFERENCE_PREFIX_MAX_LENGTH = 32
+
+# The transaction states that are reconciled with WiPay when no notification was received.
+RECONCILABLE_STATES = ('draft', 'pending')
+
+# The number of days the ledger keeps the notifications to suppress their duplicates.
+LEDGER_RETENTION_DAYS = 30
+
+# The number of days the processed notifications are kept in the queue, with their payload.
+NOTIFICATION_RETENTION_DAYS = 7
+
+# The product fields on which the cached WiPay payment product depends.
+PRODUCT_METADATA_FIELDS = {'type', 'sale_ok', 'active', 'company_id'}
+
+# The payload fields whose values are masked in the logs.
+REDACTED_LOG_FIELDS = {
+    'account_number',
+    'addr1',
+    'addr2',
+    'email',
+    'name',
+    'phone',
+    'signature',
+    'zipcode',
+}
+
+# The number of minutes during which a prefetched hosted-payment session can be reused. WiPay keeps
+# the sessions open for longer; the margin covers the time the customer spends on the payment page.
+PREFETCHED_SESSION_TTL = 10
+
+# The columns of the WiPay settlement reports, by normalized name (lowercase, words joined by
+# underscores), mapped to the keys used by the importer.
+SETTLEMENT_COLUMNS = {
+    'transaction_id': 'transaction_id',
+    'wipay_transaction_id': 'transaction_id',
+    'order_id': 'reference',
+    'reference': 'reference',
+    'total': 'amount',
+    'amount': 'amount',
+    'gross': 'amount',
+    'fee': 'fee',
+    'fees': 'fee',
+    'net': 'net',
+    'net_amount': 'net',
+    'currency': 'currency',
+}
@@ -1,15 +1,16 @@
 
+import hmac
 import json
 import logging
-import pprint
-import hashlib
 
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import Forbidden, NotFound, TooManyRequests, abort
 
 from odoo import http
 from odoo.exceptions import ValidationError
 from odoo.http import request
 
+from odoo.addons.payment_wipay import logging_utils, metrics
+
 _logger = logging.getLogger(__name__)
 
 
@@ -17,31 +18,65 @@ class WipayController(http.Controller):
     _return_url = '/payment/wipay/return'
     _webhook_url = '/payment/wipay/webhook'
     _pay_route = '/payment/wipay/pay'
+    _metrics_route = '/payment/wipay/metrics'
+    _prefetch_route = '/payment/wipay/prefetch'
 
-    @http.route('/payment/wipay/return', type='http', auth='public', website=True)
-    def wipay_return(self, **kwargs):
-        tx_ref = kwargs.get('order_id') or kwargs.get('transaction_id')
-        message = kwargs.get('message', '')
-        status = kwargs.get('status', 'failed')
+    @staticmethod
+    def _wipay_check_rate_limit(route):
+        """ Reject the request with a 429 response if the caller exceeded the rate limit of the route.
 
-        tx = request.env['payment.transaction'].sudo().search([('reference', '=', tx_ref)], limit=1)
-        if tx:
+        The caller is identified by its IP address and, if logged in, by its partner. The request is
+        aborted with the response itself rather than with an exception, which `json` routes would
+        turn into a JSON-RPC error sent with a 200 status.
 
-            # Update status
-            if status == 'success':
-                tx._set_done()  # ✅ Odoo standard for marking transaction as paid
-            else:
+        :param str route: The route, as a key of `const.RATE_LIMITS`.
+        :return: None
+        :raise HTTPException: If the caller exceeded the rate limit.
+        """
+        keys = [f'ip:{request.httprequest.remote_addr}']
+        if not request.env.user._is_public():
+            keys.append(f'partner:{request.env.user.partner_id.id}')
+        retry_after = request.env['payment.wipay.rate.limit'].sudo()._consume(route, keys)
+        if retry_after:
+            abort(TooManyRequests(retry_after=max(1, round(retry_after))).get_response())
 
-                tx._set_error(f"Payment declined: {message}")
+    @staticmethod
+    def _wipay_is_known_reference(reference):
+        """ Return whether the reference is that of a WiPay transaction.
 
-        request.env['payment.transaction'].sudo()._handle_notification_data('wipay',kwargs)
+        :param str reference: The reference of the notification.
+        :return: Whether a WiPay transaction has the reference.
+        :rtype: bool
+        """
+        if not reference or not isinstance(reference, str):
+            return False
+        return bool(request.env['payment.transaction'].sudo().search_count([
+            ('reference', '=', reference),
+            ('provider_id', 'in', request.env['payment.provider']._wipay_get_provider_ids()),
+        ], limit=1))
+
+    @http.route('/payment/wipay/return', type='http', auth='public', website=True)
+    def wipay_return(self, **kwargs):
+        """ Process the notification data sent by Wipay when the customer is redirected back.
+
+        The notification goes through the same idempotent processing as the webhook so that the
+        transaction is only updated once, whichever of the two is received first.
+        """
+        self._wipay_check_rate_limit('return')
+        metrics.inc('wipay_notifications_total', source='return')
+        request.env['payment.transaction'].sudo()._handle_notification_data('wipay', kwargs)
         return request.redirect('/payment/status')
 
     @http.route(_webhook_url, type='http', auth='public', methods=['POST'], csrf=False)
     def wipay_webhook(self, **data):
-        """ Process the notification data sent by Wipay to the webhook."""
-        _logger.info("Received Wipay webhook data:\n%s", pprint.pformat(data))
-        
+        """ Process the notification data sent by Wipay to the webhook.
+
+        WiPay sends its notifications from a few IP addresses only, so the rate limit is only
+        applied to the notifications that match no WiPay transaction: a burst of genuine
+        notifications is never rejected.
+        """
+        metrics.inc('wipay_notifications_total', source='webhook')
+
         # If the data is in the request body rather than in the query parameters
         if not data and request.httprequest.data:
             try:
@@ -49,9 +84,12 @@ class WipayController(http.Controller):
             except (ValueError, json.JSONDecodeError):
                 _logger.exception("Unable to decode webhook data from Wipay")
                 raise Forbidden()
-        
+        logging_utils.log_event('webhook.received', data)
+        if not self._wipay_is_known_reference(data.get('order_id')):
+            self._wipay_check_rate_limit('webhook')
+
         try:
-            request.env['payment.transaction'].sudo()._handle_notification_data('wipay', data)
+            request.env['payment.transaction'].sudo()._wipay_ingest_notification(data)
         except ValidationError:
             _logger.exception("Unable to handle notification data from Wipay")
             return 'ko'
@@ -59,29 +97,73 @@ class WipayController(http.Controller):
         return 'ok'
         
     @http.route(_pay_route, type='json', auth='public')
-    def wipay_pay(self, provider_id, payment_method_id=233, amount=None, flow=None, currency_id=None,
-                  partner_id=None, invoice_id=None, access_token=None, **kwargs):
+    def wipay_pay(self, provider_id, payment_method_id=None, amount=None, flow=None,
+                  currency_id=None, partner_id=None, invoice_id=None, access_token=None, **kwargs):
+        """ Create a transaction and return the values to redirect the customer to WiPay.
 
-        base_url = request.env['payment.provider'].get_base_url()
-        
-        # Create the transaction
-        provider_sudo = request.env['payment.provider'].sudo().browse(provider_id)
-        reference = request.env['payment.transaction']._compute_reference(
-            provider_code=provider_sudo.code, prefix=kwargs.get('prefix')
+        The request must carry the access token of its partner, amount and currency, as generated
+        by `payment_utils.generate_access_token`. The payment method is the WiPay one of the
+        provider's company; `payment_method_id` is only accepted for backward compatibility.
+        """
+        self._wipay_check_rate_limit('pay')
+        tx_sudo = request.env['payment.transaction'].sudo()._wipay_create_pay_transaction(
+            provider_id,
+            amount,
+            currency_id,
+            partner_id,
+            access_token,
+            invoice_id=invoice_id,
+            prefix=kwargs.get('prefix'),
         )
+        return tx_sudo._get_processing_values()
 
+    @http.route(_prefetch_route, type='json', auth='public', website=True)
+    def wipay_prefetch(self, provider_id, **kwargs):
+        """ Prefetch the hosted-payment session of the current cart while the customer reviews it.
 
-        tx_sudo = request.env['payment.transaction'].sudo().create({
-            'provider_id': provider_id,
-            'reference': reference,
-            'amount': amount,
-            'currency_id': currency_id,
-            'partner_id': partner_id,
-            'operation': 'online_direct',
-            'payment_method_line_id': 233,
-            'payment_method_id': 233,
-            'invoice_ids': [(6, 0, [invoice_id])] if invoice_id else None,
-        })
-        
-        # Process payment and get redirect
-        return tx_sudo._get_processing_values()
\ No newline at end of file
+        The session is requested in the background when WiPay is shown on the checkout page, so
+        that the customer is redirected without waiting for WiPay once they confirm the payment.
+        Failures are only logged: the session is then requested at confirmation, as usual.
+
+        :param int provider_id: The provider handling the transaction, as a `payment.provider` id.
+        :return: Whether a session is ready for the cart.
+        :rtype: dict
+        """
+        self._wipay_check_rate_limit('prefetch')
+        order_sudo = request.website.sale_get_order()
+        provider_sudo = request.env['payment.provider'].sudo().browse(int(provider_id)).exists()
+        if not order_sudo or not order_sudo.order_line or provider_sudo.code != 'wipay':
+            return {'prefetched': False}
+
+        try:
+            session = request.env['payment.transaction'].sudo()._wipay_prefetch_session(
+                provider_sudo, order_sudo
+            )
+        except Exception as error:  # noqa: BLE001 - prefetching is best effort.
+            metrics.inc('wipay_prefetched_sessions_total', outcome='error')
+            _logger.warning("Unable to prefetch the WiPay session of %s: %s", order_sudo.name, error)
+            return {'prefetched': False}
+        return {'prefetched': bool(session)}
+
+    @http.route(_metrics_route, type='http', auth='public', methods=['GET'], csrf=False)
+    def wipay_metrics(self, token=None, **kwargs):
+        """ Expose the metrics of the serving worker in the Prometheus text format.
+
+        The route is only available once the `payment_wipay.metrics_token` system parameter is set,
+        and the token must be given either as a bearer token or in the `token` query parameter.
+        """
+        expected_token = request.env['ir.config_parameter'].sudo().get_param(
+            'payment_wipay.metrics_token'
+        )
+        if not expected_token:
+            raise NotFound()
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        if not token or not hmac.compare_digest(token.encode(), expected_token.encode()):
+            raise Forbidden()
+
+        body = metrics.render(request.env['payment.transaction'].sudo()._wipay_get_metric_gauges())
+        return request.make_response(
+            body, headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')]
+        )
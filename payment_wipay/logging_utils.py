@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+""" Structured, sampled and redacted event logging for the WiPay integration.
+
+Events are logged on the `odoo.addons.payment_wipay.events` logger, which hands its records to a
+queue; a background thread formats them and passes them to the handlers of the root logger. The
+request threads thus never format payloads nor block on log I/O, and payloads are only copied when
+the event is actually emitted.
+
+The behavior can be tuned in the Odoo configuration file:
+
+- `wipay_log_sample_rate`: the fraction (0 to 1) of the events below WARNING that are emitted;
+- `wipay_log_redact_fields`: comma-separated names of extra payload fields to redact.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import pprint
+import queue
+import random
+import threading
+
+from odoo.tools import config
+
+from odoo.addons.payment_wipay import const
+
+_event_logger = logging.getLogger('odoo.addons.payment_wipay.events')
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class _Payload:
+    """ Payload of an event, redacted and pretty-printed only when the record is formatted. """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pprint.pformat(redact(self.data))
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler leaving the formatting of the records to the listener thread. """
+
+    def prepare(self, record):
+        # Odoo's formatter reads the database name from the current thread; keep it for later.
+        record.wipay_dbname = getattr(threading.current_thread(), 'dbname', '?')
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+
+    def handle(self, record):
+        threading.current_thread().dbname = record.wipay_dbname
+        super().handle(record)
+
+
+def _get_redacted_fields():
+    extra_fields = config.get('wipay_log_redact_fields') or ''
+    return const.REDACTED_LOG_FIELDS | {
+        field.strip() for field in extra_fields.split(',') if field.strip()
+    }
+
+
+def _get_sample_rate():
+    try:
+        return float(config.get('wipay_log_sample_rate', 1.0))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def redact(data):
+    """ Return a copy of the data where the values of sensitive fields are masked.
+
+    :param data: The data to redact; dicts and lists are redacted recursively.
+    :return: The redacted data.
+    """
+    if isinstance(data, dict):
+        redacted_fields = _get_redacted_fields()
+        return {
+            key: '***' if key in redacted_fields and value else redact(value)
+            for key, value in data.items()
+        }
+    if isinstance(data, (list, tuple)):
+        return [redact(value) for value in data]
+    return data
+
+
+def _ensure_listener():
+    global _listener
+    if _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is not None:
+            return
+        records = queue.SimpleQueue()
+        _listener = _Listener(records, *logging.getLogger().handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        _event_logger.addHandler(_DeferredQueueHandler(records))
+        _event_logger.propagate = False
+
+
+def log_event(event, data=None, level=logging.INFO, **fields):
+    """ Log a structured event about the WiPay integration.
+
+    Events below WARNING are subject to sampling. The payload is shallow-copied so that later
+    changes of the data do not alter the record, and is redacted when formatted.
+
+    :param str event: The name of the event, e.g., `checkout.request`.
+    :param dict data: The payload of the event.
+    :param int level: The logging level of the event.
+    :param dict fields: Additional fields added to the payload.
+    :return: None
+    """
+    if not _event_logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING and random.random() >= _get_sample_rate():
+        return
+    _ensure_listener()
+    _event_logger.log(level, "WiPay event %s: %s", event, _Payload(dict(data or {}, **fields)))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""" Per-worker counters and histograms of the WiPay integration, in Prometheus text format.
+
+Recording a value costs a dictionary lookup and a few additions under a lock, which is cheap
+enough to stay enabled in production. Each worker process keeps its own values; they are exposed
+by the worker that serves the `/payment/wipay/metrics` route, labelled with its pid.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# The upper bounds, in seconds, of the buckets of the duration histograms.
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_help = {
+    'wipay_phase_duration_seconds': "Duration of the phases of the WiPay hot paths.",
+    'wipay_api_request_duration_seconds': "Round-trip duration of the requests to the WiPay API.",
+    'wipay_api_requests_total': "Requests made to the WiPay API, by outcome.",
+    'wipay_notifications_total': "WiPay notifications received, by source.",
+    'wipay_rate_limited_total': "Requests rejected by the rate limit of the public routes.",
+    'wipay_prefetched_sessions_total': "Prefetched WiPay hosted-payment sessions, by outcome.",
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """ Increment a counter. """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """ Record a value in a histogram with the buckets `DURATION_BUCKETS`. """
+    key = _key(name, labels)
+    index = bisect.bisect_left(DURATION_BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(DURATION_BUCKETS) + 1), 0.0, 0]
+        histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextmanager
+def phase(name, **labels):
+    """ Record the duration of the block in the phase histogram, whether it raises or not. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('wipay_phase_duration_seconds', time.perf_counter() - start, phase=name, **labels)
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for label, value in sorted(labels.items())
+    )
+
+
+def render(gauges=None):
+    """ Return the metrics of this worker in the Prometheus text exposition format.
+
+    :param dict gauges: Additional gauges to expose, as a {name: value} dict.
+    :return: The metrics.
+    :rtype: str
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+
+    pid = os.getpid()
+    lines = []
+    declared = set()
+
+    def _declare(name, kind):
+        if name not in declared:
+            declared.add(name)
+            if name in _help:
+                lines.append(f'# HELP {name} {_help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        _declare(name, 'counter')
+        lines.append(f'{name}{_format_labels(labels, pid=pid)} {value}')
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        _declare(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip((*DURATION_BUCKETS, '+Inf'), buckets):
+            cumulative += bucket_count
+            lines.append(
+                f'{name}_bucket{_format_labels(labels, pid=pid, le=bound)} {cumulative}'
+            )
+        lines.append(f'{name}_sum{_format_labels(labels, pid=pid)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels, pid=pid)} {count}')
+    for name, value in sorted((gauges or {}).items()):
+        _declare(name, 'gauge')
+        lines.append(f'{name}{_format_labels({}, pid=pid)} {value}')
+    return '\n'.join(lines) + '\n'
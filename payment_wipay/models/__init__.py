@@ -1,5 +1,17 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+from . import account_payment_method_line
+from . import payment_method
 from . import payment_provider
-from . import payment_transaction
\ No newline at end of file
+from . import payment_transaction
+from . import payment_wipay_endpoint
+from . import payment_wipay_ledger
+from . import payment_wipay_notification
+from . import payment_wipay_rate_limit
+from . import payment_wipay_session
+from . import payment_wipay_settlement
+from . import payment_wipay_stats
+from . import product_product
+from . import product_template
+from . import res_currency_rate
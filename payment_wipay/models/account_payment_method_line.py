@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+
+class AccountPaymentMethodLine(models.Model):
+    _inherit = 'account.payment.method.line'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if self._wipay_get_journal_ids() & {vals.get('journal_id') for vals in vals_list}:
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay method lines.
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if {'journal_id', 'payment_method_id', 'sequence'} & vals.keys() and (
+            self._wipay_get_journal_ids() & {vals.get('journal_id'), *self.journal_id.ids}
+        ):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay method lines.
+        return super().write(vals)
+
+    def unlink(self):
+        if self._wipay_get_journal_ids() & set(self.journal_id.ids):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay method lines.
+        return super().unlink()
+
+    @api.model
+    def _wipay_get_journal_ids(self):
+        """ Return the ids of the journals of the WiPay providers, whose method lines are cached.
+
+        :return: The journal ids.
+        :rtype: set
+        """
+        Provider = self.env['payment.provider'].sudo()
+        return set(Provider.browse(Provider._wipay_get_provider_ids()).journal_id.ids)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+
+class PaymentMethod(models.Model):
+    _inherit = 'payment.method'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if any(vals.get('code') == 'wipay' for vals in vals_list):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay metadata.
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if {'code', 'active', 'company_id', 'supported_country_ids'} & vals.keys() and (
+            vals.get('code') == 'wipay' or any(method.code == 'wipay' for method in self)
+        ):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay metadata.
+        return super().write(vals)
+
+    def unlink(self):
+        if any(method.code == 'wipay' for method in self):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay metadata.
+        return super().unlink()
@@ -2,10 +2,13 @@
 
 import logging
 import requests
+from werkzeug import urls
 
-from odoo import _, api, fields, models
-from odoo.exceptions import ValidationError
-from odoo.addons.website.models import ir_http
+from odoo import _, api, fields, models, tools
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import frozendict
+
+from odoo.addons.payment_wipay import const, signature, utils
 
 _logger = logging.getLogger(__name__)
 
@@ -37,6 +40,41 @@ class PaymentProvider(models.Model):
         help="The base URL for WiPay API requests",
     )
 
+    wipay_connect_timeout = fields.Float(
+        string="Connect Timeout",
+        help="The number of seconds to wait for the connection to WiPay to be established",
+        default=5.0,
+    )
+    wipay_read_timeout = fields.Float(
+        string="Read Timeout",
+        help="The number of seconds to wait for WiPay to answer once connected",
+        default=30.0,
+    )
+    wipay_max_retries = fields.Integer(
+        string="Max Retries",
+        help="The number of times a failed connection to WiPay is retried before giving up",
+        default=2,
+    )
+    wipay_webhook_queue = fields.Boolean(
+        string="Queue Webhook Notifications",
+        help="Acknowledge webhook notifications immediately and process them in batches in the "
+             "background",
+    )
+    wipay_region_routing = fields.Boolean(
+        string="Automatic Region Routing",
+        help="Send the requests to the fastest healthy WiPay region supporting the currency, "
+             "instead of the configured API URL",
+    )
+
+    wipay_signature_scheme = fields.Selection(
+        string="Signature Scheme",
+        help="The hash used to sign the payment requests and the notifications, as set in the "
+             "WiPay account",
+        selection=[('md5', "MD5"), ('sha256', "SHA-256"), ('hmac_sha256', "HMAC-SHA256")],
+        required=True,
+        default='md5',
+    )
+
     wipay_currency = fields.Selection([
         ('TTD', 'TTD'),
         ('JMD', 'JMD'),
@@ -46,13 +84,240 @@ class PaymentProvider(models.Model):
     @api.onchange('wipay_currency')
     def _onchange_wipay_currency(self):
         """Auto-update the API URL when the currency is changed."""
-        currency_url_map = {
-            'TTD': 'https://tt.wipayfinancial.com/plugins/payments/request',
-            'JMD': 'https://jm.wipayfinancial.com/plugins/payments/request',
-            'USD': 'https://tt.wipayfinancial.com/plugins/payments/request',  # Defaulting USD to TT
+        regions = const.CURRENCY_REGIONS.get(self.wipay_currency, ())
+        routing_table = self.env['payment.wipay.endpoint']._get_routing_table()
+        base_url = regions and routing_table.get(regions[0], ('',))[0]
+        self.wipay_api_url = base_url and urls.url_join(base_url, const.API_ENDPOINTS['request'])
+
+    # === BUSINESS METHODS === #
+
+    def _wipay_make_request(self, url, payload=None, method='POST'):
+        """ Make a request to the WiPay API through the pooled session of the provider.
+
+        Every outbound call to WiPay must go through this method so that connections are reused, the
+        configured timeouts and retry budget apply and the round-trip time is recorded.
+
+        :param str url: The URL to call.
+        :param dict payload: The payload of the request.
+        :param str method: The HTTP method of the request.
+        :return: The JSON-formatted content of the response.
+        :rtype: dict
+        :raise ValidationError: If an HTTP error occurs or the response is not valid JSON.
+        """
+        self.ensure_one()
+
+        spec = self._wipay_get_request_spec()
+        try:
+            return utils.send_request(spec, url, payload=payload, method=method)
+        except requests.exceptions.RequestException as error:
+            _logger.exception("Unable to reach WiPay at %s", url)
+            raise ValidationError(
+                "WiPay: " + _("Could not establish the connection to the API: %s", error)
+            )
+        except ValueError:
+            _logger.exception("Invalid JSON response received from WiPay at %s", url)
+            raise ValidationError("WiPay: " + _("Received an invalid response from the API."))
+
+    def _wipay_get_request_spec(self):
+        """ Return the pooled session, headers and timeouts to use to call WiPay.
+
+        The spec holds no reference to the environment and can be handed over to worker threads.
+
+        :return: The request spec of the provider.
+        :rtype: utils.RequestSpec
+        """
+        self.ensure_one()
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/x-www-form-urlencoded',
         }
+        if self.wipay_api_key:
+            headers['Authorization'] = f"Bearer {self.wipay_api_key}"
+        key = self._wipay_get_session_key()
+        return utils.RequestSpec(
+            key=key,
+            session=utils.get_session(key, max(self.wipay_max_retries, 0)),
+            headers=headers,
+            timeout=(self.wipay_connect_timeout or None, self.wipay_read_timeout or None),
+        )
+
+    def _wipay_get_api_url(self, endpoint='request'):
+        """ Return the URL of a WiPay API endpoint.
+
+        With region routing, the endpoint is served by the fastest healthy region eligible for the
+        WiPay currency of the provider. Otherwise, it is served by the host of the configured API
+        URL, which is used as is for hosted-payment requests.
+
+        :param str endpoint: The endpoint, as a key of `const.API_ENDPOINTS`.
+        :return: The URL of the endpoint.
+        :rtype: str
+        """
+        self.ensure_one()
+        if self.wipay_region_routing:
+            _region, base_url = self.env['payment.wipay.endpoint']._select_region(
+                const.CURRENCY_REGIONS[self.wipay_currency]
+            )
+        elif endpoint == 'request':
+            return self.wipay_api_url
+        else:
+            base_url = self.wipay_api_url
+        return urls.url_join(base_url, const.API_ENDPOINTS[endpoint])
+
+    @api.model
+    def _wipay_is_webhook_queued(self):
+        """ Return whether webhook notifications must be queued rather than processed inline. """
+        return bool(self.sudo().search_count(
+            [('code', '=', 'wipay'), ('wipay_webhook_queue', '=', True)], limit=1
+        ))
+
+    @api.model
+    @tools.ormcache()
+    def _wipay_get_provider_ids(self):
+        """ Return the ids of all WiPay providers, cached in the registry.
+
+        Looking transactions up by `provider_id` rather than by the related `provider_code` avoids
+        a join with the provider table.
+
+        :return: The ids of the WiPay providers.
+        :rtype: tuple
+        """
+        return tuple(self.sudo().search([('code', '=', 'wipay')]).ids)
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _wipay_get_metadata(self, company_id):
+        """ Return the ids of the payment methods used by WiPay payments of a company, cached in the
+        registry.
+
+        The cache is invalidated whenever a WiPay payment method is created, updated or deleted; see
+        the overrides of `create`, `write` and `unlink` on `payment.method`.
+
+        :param int company_id: The company of the provider or the transaction.
+        :return: The ids of the WiPay payment method and of its default payment method as declared
+                 in the data.
+        :rtype: frozendict
+        """
+        env = self.with_company(company_id).env
+        default_method = env.ref('payment_wipay.payment_method_wipay', raise_if_not_found=False)
+        payment_method = env['payment.method'].search([('code', '=', 'wipay')], limit=1)
+        return frozendict({
+            'default_payment_method_id': default_method.id if default_method else False,
+            'payment_method_id': payment_method.id,
+        })
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _wipay_get_product_id(self, company_id):
+        """ Return the id of the payment product of a company, cached in the registry.
+
+        The cache is invalidated whenever a service product is created, updated or deleted; see the
+        overrides of `create`, `write` and `unlink` on `product.product` and `product.template`.
+
+        :param int company_id: The company of the provider.
+        :return: The id of the first saleable service product, if any.
+        :rtype: int
+        """
+        return self.with_company(company_id).env['product.product'].search(
+            [('type', '=', 'service'), ('sale_ok', '=', True)], order='id', limit=1
+        ).id
+
+    @api.model
+    @tools.ormcache('journal_id', 'method_codes')
+    def _wipay_get_method_line_id(self, journal_id, method_codes):
+        """ Return the id of the first payment method line of a journal with one of the given codes.
+
+        :param int journal_id: The journal of the method line.
+        :param tuple method_codes: The accepted codes of the payment method.
+        :return: The id of the payment method line, if any.
+        :rtype: int
+        """
+        return self.env['account.payment.method.line'].search([
+            ('journal_id', '=', journal_id),
+            ('payment_method_id.code', 'in', list(method_codes)),
+        ], limit=1).id
+
+    @api.model
+    @tools.ormcache('currency_name')
+    def _wipay_get_currency_id(self, currency_name):
+        """ Return the id of the currency with the given ISO code, cached in the registry. """
+        return self.env['res.currency'].with_context(active_test=False).search(
+            [('name', '=', currency_name)], limit=1
+        ).id
+
+    @api.model
+    @tools.ormcache('from_currency_id', 'to_currency_id', 'company_id', 'date')
+    def _wipay_get_conversion_rate(self, from_currency_id, to_currency_id, company_id, date):
+        """ Return the conversion rate between two currencies, cached in the registry.
+
+        The cache is invalidated whenever a `res.currency.rate` record is created, updated or
+        deleted.
+        """
+        Currency = self.env['res.currency']
+        return Currency._get_conversion_rate(
+            Currency.browse(from_currency_id),
+            Currency.browse(to_currency_id),
+            self.env['res.company'].browse(company_id),
+            date,
+        )
+
+    def _wipay_convert_amount(self, amount, currency, date=None):
+        """ Convert an amount into the WiPay currency of the provider.
+
+        This is equivalent to `res.currency._convert` with the current company, but the currency and
+        the conversion rate are read from the registry cache.
+
+        :param float amount: The amount to convert.
+        :param recordset currency: The currency of the amount, as a `res.currency` record.
+        :param date date: The date of the conversion rate; defaults to today.
+        :return: The converted and rounded amount.
+        :rtype: float
+        :raise UserError: If the WiPay currency is not found.
+        """
+        self.ensure_one()
+        to_currency = self.env['res.currency'].browse(
+            self._wipay_get_currency_id(self.wipay_currency)
+        )
+        if not to_currency:
+            raise UserError(_("Wipay: Currency %s not found.", self.wipay_currency))
+        if currency == to_currency:
+            return amount
+        rate = self._wipay_get_conversion_rate(
+            currency.id, to_currency.id, self.env.company.id, date or fields.Date.context_today(self)
+        )
+        return to_currency.round(amount * rate)
+
+    def _wipay_sign_request(self, *fields):
+        """ Return the signature of a payment request, keyed with the API key of the provider.
+
+        :param list fields: The signed fields, in order.
+        :return: The signature.
+        :rtype: str
+        """
+        self.ensure_one()
+        return signature.get_signer(self.wipay_signature_scheme, self.wipay_api_key).sign(*fields)
+
+    def _wipay_verify_notification(self, received_signature, *fields):
+        """ Return whether the signature of a notification is valid, in constant time.
 
-        self.wipay_api_url = currency_url_map.get(self.wipay_currency, '')
+        :param str received_signature: The signature sent by WiPay.
+        :param list fields: The signed fields, in order.
+        :return: Whether the signature is valid.
+        :rtype: bool
+        """
+        self.ensure_one()
+        return signature.get_signer(
+            self.wipay_signature_scheme, self.wipay_secret_key
+        ).verify(received_signature, *fields)
+
+    def _wipay_get_session_key(self):
+        """ Return the key identifying the pooled session and the timings of the provider. """
+        self.ensure_one()
+        return self.env.cr.dbname, self.id
+
+    def _wipay_get_latency_stats(self):
+        """ Return the round-trip statistics of the recent calls made to WiPay by this worker. """
+        self.ensure_one()
+        return utils.get_latency_stats(self._wipay_get_session_key())
 
 
 
@@ -60,7 +325,7 @@ class PaymentProvider(models.Model):
         self.ensure_one()
         if self.code != 'wipay':
             return super()._get_default_payment_method_id()
-        return self.env.ref('payment_wipay.payment_method_wipay').id
+        return self._wipay_get_metadata(self.company_id.id)['default_payment_method_id']
         
     def _should_show_payment_icon_wizard(self):
         self.ensure_one()
@@ -71,7 +336,11 @@ class PaymentProvider(models.Model):
         
         # For Wipay, we only require the merchant account ID and API key
         if self.code == 'wipay':
-            return not (self.wipay_merchant_account_id and self.wipay_api_key and self.wipay_api_url)
+            return not (
+                self.wipay_merchant_account_id
+                and self.wipay_api_key
+                and (self.wipay_api_url or self.wipay_region_routing)
+            )
         
         return super()._is_missing_required_fields()
         
@@ -96,9 +365,21 @@ class PaymentProvider(models.Model):
     def create(self, values):
         """ Override to force publish Wipay providers upon creation """
         res = super().create(values)
-        if res.code == 'wipay' and res.state != 'disabled' and 'is_published' not in values:
-            res.write({'is_published': True})
+        if res.code == 'wipay':
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay provider ids.
+            if res.state != 'disabled' and 'is_published' not in values:
+                res.write({'is_published': True})
         return res
+
+    def write(self, values):
+        if 'code' in values:
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay provider ids.
+        return super().write(values)
+
+    def unlink(self):
+        if any(provider.code == 'wipay' for provider in self):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay provider ids.
+        return super().unlink()
         
         
     def _get_payment_product_id(self):
@@ -106,7 +387,7 @@ class PaymentProvider(models.Model):
         self.ensure_one()
         if self.code != 'wipay':
             return super()._get_payment_product_id()
-        return self.env['product.product'].search([('detailed_type', '=', 'service'), ('sale_ok', '=', True)], limit=1).id
+        return self._wipay_get_product_id(self.company_id.id)
         
     def _should_show_in_website_express_checkout(self):
         """ Override to enable express checkout for Wipay. """
@@ -115,19 +396,15 @@ class PaymentProvider(models.Model):
         return super()._should_show_in_website_express_checkout()
         
     def _is_available_for_country(self, country_code=None):
+        if self.code != 'wipay':
+            return super()._is_available_for_country(country_code)
+        # The countries of the provider are read from the record cache, without a country search.
+        return (
+            not country_code
+            or not self.available_country_ids
+            or country_code in self.available_country_ids.mapped('code')
+        )
 
-        if self.code == 'wipay':
-            # Make Wipay available for all countries in test mode
-            if self.state == 'test':
-                return True
-                
-
-            available_countries = ['TT']  # Add other countries as needed
-            if not country_code or country_code in available_countries:
-                return True
-            return False
-        return super()._is_available_for_country(country_code)
-        
     def _is_available_for_sale_order(self, sale_order):
         """ Override to make Wipay available for sale orders.
         
@@ -172,24 +449,18 @@ class PaymentProvider(models.Model):
     def _compute_feature_support_fields(self):
         """ Override of payment to enable additional features. """
         super()._compute_feature_support_fields()
-        if self.code != 'wipay':
-            return
-            
-        # In Odoo 18, the field names might have changed
-        # Use hasattr to check which fields exist and set them accordingly
-        if hasattr(self, 'support_fees'):
-            self.support_fees = True  # Support payment fees
-        if hasattr(self, 'fees_active'):
-            self.fees_active = True  # Support payment fees (new name)
-        if hasattr(self, 'allow_express_checkout'):
-            self.allow_express_checkout = True
-        if hasattr(self, 'support_manual_capture'):
-            self.support_manual_capture = False
-        if hasattr(self, 'capture_manually'):
-            self.capture_manually = False
-        if hasattr(self, 'support_refund'):
-            self.support_refund = 'partial'
-        if hasattr(self, 'support_tokenization'):
-            self.support_tokenization = False
-        if hasattr(self, 'allow_tokenization'):
-            self.allow_tokenization = False
\ No newline at end of file
+        self.filtered(lambda p: p.code == 'wipay').update(const.FEATURE_SUPPORT)
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _wipay_get_supported_country_codes(self, company_id):
+        """ Return the codes of the billing countries supported by the WiPay payment method.
+
+        :param int company_id: The company of the transaction.
+        :return: The country codes.
+        :rtype: frozenset
+        """
+        payment_method = self.env['payment.method'].browse(
+            self._wipay_get_metadata(company_id)['payment_method_id']
+        )
+        return frozenset(payment_method.supported_country_ids.mapped('code'))
@@ -1,36 +1,49 @@
 # Updated WiPay payment integration with fixed error handling
 
-import datetime
 import logging
-import pdb
-import pprint
+import re
+import unicodedata
+
 import requests
-import json
-import hashlib
+from dateutil.relativedelta import relativedelta
 from werkzeug import urls
 
-from odoo import _, fields, models
-from odoo.exceptions import UserError
-from odoo.http import request
+from odoo import _, Command, api, fields, models
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import split_every
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_wipay import const, logging_utils, metrics, utils
 
 _logger = logging.getLogger(__name__)
 
+# The default statistics of the reconciliation of pending transactions, before its first run.
+RECONCILE_STATS = {
+    'runs': 0,
+    'checked': 0,
+    'reconciled': 0,
+    'errors': 0,
+    'last_run_duration': 0.0,
+    'last_run_throughput': 0.0,
+}
+
 
 class PaymentTransaction(models.Model):
     _inherit = 'payment.transaction'
 
-    wipay_payment_id = fields.Char("Wipay Payment ID")
+    wipay_payment_id = fields.Char("Wipay Payment ID", index='btree_not_null')
+    wipay_amount = fields.Float(
+        "Wipay Amount", help="The amount charged or refunded by WiPay, in the WiPay currency."
+    )
 
     def _get_payment_method_line_fields(self):
         res = super()._get_payment_method_line_fields()
         if self.provider_code == 'wipay' and not res.get('payment_method_line_id'):
-            journal = self.acquirer_id.journal_id
-            method_line = self.env['account.payment.method.line'].search([
-                ('journal_id', '=', journal.id),
-                ('payment_method_id.code', '=', 'manual'),
-            ], limit=1)
-            if method_line:
-                res['payment_method_line_id'] = method_line.id
+            method_line_id = self.env['payment.provider']._wipay_get_method_line_id(
+                self.provider_id.journal_id.id, ('manual',)
+            )
+            if method_line_id:
+                res['payment_method_line_id'] = method_line_id
         return res
 
     def _get_specific_rendering_values(self, processing_values):
@@ -38,117 +51,357 @@ class PaymentTransaction(models.Model):
             res = super()._get_specific_rendering_values(processing_values)
             if self.provider_code != 'wipay':
                 return res
-            base_url = self.provider_id.get_base_url()
-            return_url = urls.url_join(base_url, '/payment/wipay/return')
-            notify_url = urls.url_join(base_url, '/payment/wipay/webhook')
-            origin = "WiPay"
             country_code = self.partner_id.country_id.code
-            payment_data = {
-                'account_number': self.provider_id.wipay_merchant_account_id,
-                'order_id': self.reference,
-                'environment': 'live' if self.provider_id.state == 'enable' else 'sandbox',
-                'response_url': return_url,
-                'webhook_url': notify_url,
-                'email': self.partner_email,
-                'name': self.partner_name,
-                'phone': self.partner_phone,
-                'zipcode': self.partner_zip,
-                'addr1': self.partner_address,
-                'addr2': self.partner_city,
-                'origin': origin,
-                'fee_structure': 'customer_pay',
-                'method': 'credit_card',
-                'description': f"Payment for {self.reference}"
-            }
-
-            if self.provider_id.wipay_api_key:
-                signature_string = f"{self.provider_id.wipay_api_key}{self.provider_id.wipay_merchant_account_id}{self.amount:.2f}{self.reference}"
-                signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
-                payment_data['signature'] = signature
 
             try:
-                _logger.info("Making request to Wipay with data: %s", pprint.pformat(payment_data))
-                headers = {
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-
-                if self.provider_id.wipay_api_key:
-                    headers['Authorization'] = f"Bearer {self.provider_id.wipay_api_key}"
-
-                if country_code not in ['TT', 'BB', 'JM']:
+                if country_code not in self.provider_id._wipay_get_supported_country_codes(
+                    self.company_id.id
+                ):
                     self._set_error(f"Wipay: Country {self.partner_id.country_id.name} not supported, Check your Billing Address.")
                     raise UserError(_("Wipay: Country %s not supported, Check your Billing Address.") % self.partner_id.country_id.name)
 
-                pay_currency = self.currency_id.name
-                if pay_currency != self.provider_id.wipay_currency:
-                    src_currency = self.env['res.currency'].search([('name', '=', self.provider_id.wipay_currency)])
-                    print(self.amount)
-                    print(src_currency.name)
-
-                    print(self.currency_id.name)
-                    pay_amount = self.currency_id._convert(self.amount, src_currency)
-                else:
-                    pay_amount = self.amount
-
-                print(pay_amount)
-
-                payment_data['country_code'] = country_code
-                payment_data['currency'] = self.provider_id.wipay_currency
-                payment_data['total'] = f"{pay_amount:.2f}"
-
-                response = requests.post(self.provider_id.wipay_api_url, data=payment_data, headers=headers)
-                response.raise_for_status()
-                response_data = response.json()
-                _logger.info("Received response from Wipay: %s", pprint.pformat(response_data))
-                self.provider_reference = response_data.get('transaction_id')
+                payment_data = self._wipay_prepare_payment_data()
+                api_url = self.provider_id._wipay_get_api_url('request')
+                response_data = self._wipay_request_hosted_session(api_url, payment_data)
+                with metrics.phase('orm_write', path='checkout'):
+                    tx_values = {
+                        'provider_reference': response_data.get('transaction_id'),
+                        'wipay_amount': float(payment_data['total']),
+                    }
+                    if response_data.get('url'):
+                        tx_values['wipay_payment_id'] = response_data.get('transaction_id')
+                    self.write(tx_values)
                 if response_data.get('url'):
-                    self.wipay_payment_id = response_data.get('transaction_id')
-                    payment_data.update({
-                        'payment_url': response_data.get('url'),
+                    # The query string of the action of a GET form is replaced by its inputs.
+                    payment_url = response_data['url']
+                    return {
+                        'api_url': payment_url,
+                        'url_params': urls.url_decode(urls.url_parse(payment_url).query),
                         'reference': self.reference,
                         'provider_reference': response_data.get('transaction_id'),
-                        'post_params': payment_data
-                    })
-                    return payment_data
+                    }
                 else:
                     error_msg = response_data.get('message', 'Unknown error')
                     _logger.error("Wipay payment error: %s", error_msg)
                     raise UserError(_("Wipay: %s") % error_msg)
 
-            except (requests.exceptions.RequestException, ValueError) as e:
+            except ValidationError as e:
                 _logger.exception("Error contacting Wipay API %s", str(e))
                 raise UserError(_("Could not establish connection with Wipay API: %s") % str(e))
 
         except Exception as e:
             raise UserError(_("Could not establish connection with Wipay API: %s") % str(e))
 
+    def _wipay_prepare_payment_data(self):
+        """ Return the payload of the hosted-payment request of the transaction.
+
+        The transaction can be a new record, as for the prefetching of hosted-payment sessions.
+
+        :return: The payload to post to WiPay.
+        :rtype: dict
+        """
+        base_url = self.provider_id.get_base_url()
+        return_url = urls.url_join(base_url, '/payment/wipay/return')
+        notify_url = urls.url_join(base_url, '/payment/wipay/webhook')
+        origin = "WiPay"
+        payment_data = {
+            'account_number': self.provider_id.wipay_merchant_account_id,
+            'order_id': self.reference,
+            'environment': 'live' if self.provider_id.state == 'enable' else 'sandbox',
+            'response_url': return_url,
+            'webhook_url': notify_url,
+            'email': self.partner_email,
+            'name': self.partner_name,
+            'phone': self.partner_phone,
+            'zipcode': self.partner_zip,
+            'addr1': self.partner_address,
+            'addr2': self.partner_city,
+            'origin': origin,
+            'fee_structure': 'customer_pay',
+            'method': 'credit_card',
+            'description': f"Payment for {self.reference}"
+        }
+
+        payment_data.update(self._wipay_get_amount_values(path='checkout'))
+        payment_data['country_code'] = self.partner_id.country_id.code
+        return payment_data
+
+    def _wipay_get_amount_values(self, path):
+        """ Return the signature, currency and total of the payment requests of the transaction.
+
+        :param str path: The hot path the values are computed for, used as metric label.
+        :return: The signature, if the provider has an API key, the currency and the total.
+        :rtype: dict
+        """
+        values = {}
+        if self.provider_id.wipay_api_key:
+            with metrics.phase('signature', path=path):
+                values['signature'] = self.provider_id._wipay_sign_request(
+                    self.provider_id.wipay_merchant_account_id, f'{self.amount:.2f}', self.reference
+                )
+
+        with metrics.phase('conversion', path=path):
+            pay_amount = self.provider_id._wipay_convert_amount(self.amount, self.currency_id)
+
+        values['currency'] = self.provider_id.wipay_currency
+        values['total'] = f"{pay_amount:.2f}"
+        return values
+
+    def _wipay_request_hosted_session(self, api_url, payment_data):
+        """ Return the hosted-payment session of the payload, reusing a prefetched one if possible.
+
+        :param str api_url: The URL of the hosted-payment request endpoint.
+        :param dict payment_data: The payload of the hosted-payment request.
+        :return: The response of WiPay, or the equivalent content of the prefetched session.
+        :rtype: dict
+        """
+        session = self.env['payment.wipay.session'].sudo()._find(
+            self.provider_id, self.reference, payment_data['total'], payment_data['currency']
+        )
+        if session:
+            metrics.inc('wipay_prefetched_sessions_total', outcome='hit')
+            return {'url': session.payment_url, 'transaction_id': session.wipay_payment_id}
+
+        logging_utils.log_event('checkout.request', payment_data, reference=self.reference)
+        with metrics.phase('api_request', path='checkout'):
+            response_data = self.provider_id._wipay_make_request(api_url, payload=payment_data)
+        logging_utils.log_event('checkout.response', response_data, reference=self.reference)
+        return response_data
+
+    @api.model
+    def _wipay_prefetch_session(self, provider, order):
+        """ Request the hosted-payment session of a sale order ahead of the payment confirmation.
+
+        The session is requested for the reference the transaction of the order will get, and
+        saved so that `_wipay_request_hosted_session` reuses it if the shopper confirms the payment
+        before it expires. An existing valid session is returned as is.
+
+        :param recordset provider: The WiPay provider, as a `payment.provider` record.
+        :param recordset order: The sale order being paid, as a `sale.order` record.
+        :return: The prefetched session, if any.
+        :rtype: recordset of `payment.wipay.session`
+        """
+        partner = order.partner_invoice_id
+        if partner.country_id.code not in provider._wipay_get_supported_country_codes(
+            provider.company_id.id
+        ):
+            return self.env['payment.wipay.session']
+
+        reference = self._compute_reference(
+            provider.code, sale_order_ids=[Command.set(order.ids)]
+        )
+        tx = self.new({
+            'provider_id': provider.id,
+            'reference': reference,
+            'amount': order.amount_total,
+            'currency_id': order.currency_id.id,
+            'partner_id': partner.id,
+            'partner_name': partner.name,
+            'partner_email': partner.email,
+            'partner_phone': partner.phone,
+            'partner_zip': partner.zip,
+            'partner_address': payment_utils.format_partner_address(
+                partner.street, partner.street2
+            ),
+            'partner_city': partner.city,
+        })
+        payment_data = tx._wipay_prepare_payment_data()
+        Session = self.env['payment.wipay.session'].sudo()
+        session = Session._find(
+            provider, reference, payment_data['total'], payment_data['currency']
+        )
+        if session:
+            metrics.inc('wipay_prefetched_sessions_total', outcome='reused')
+            return session
+
+        response_data = tx._wipay_request_hosted_session(
+            provider._wipay_get_api_url('request'), payment_data
+        )
+        if not response_data.get('url'):
+            return Session
+        metrics.inc('wipay_prefetched_sessions_total', outcome='prefetched')
+        return Session.create({
+            'provider_id': provider.id,
+            'reference': reference,
+            'total': payment_data['total'],
+            'currency': payment_data['currency'],
+            'payment_url': response_data['url'],
+            'wipay_payment_id': response_data.get('transaction_id'),
+        })
+
     def _get_tx_from_notification_data(self, provider_code, notification_data):
         tx = super()._get_tx_from_notification_data(provider_code, notification_data)
         if provider_code != 'wipay' or tx:
             return tx
 
         reference = notification_data.get('order_id')
-        if not reference:
-            raise UserError(_("Wipay: No transaction found matching reference %s.") % reference)
-
-        tx = self.search([('reference', '=', reference), ('provider_code', '=', 'wipay')])
+        wipay_payment_id = notification_data.get('transaction_id')
+        tx = self._wipay_lookup(reference=reference, wipay_payment_id=wipay_payment_id)
         if not tx:
-            raise UserError(_("Wipay: No transaction found matching reference %s.") % reference)
+            raise UserError(
+                _("Wipay: No transaction found matching reference %s.")
+                % (reference or wipay_payment_id)
+            )
         return tx
 
-    def _get_specific_checkout_rendering_values(self, payment_method_id=None):
-        res = super()._get_specific_checkout_rendering_values(payment_method_id)
-        if self.provider_code != 'wipay':
-            return res
-        self.provider_id.sudo().write({
-            'state': 'enabled' if self.provider_id.state == 'test' else self.provider_id.state,
+    @api.model
+    def _wipay_lookup(self, reference=None, wipay_payment_id=None):
+        """ Return the WiPay transaction matching the reference or, failing that, the payment id.
+
+        The ids of recently resolved transactions are kept in a per-worker cache so that the
+        notifications of a same payment (return, webhook, retries) only query the database once.
+        As in the database lookup, the payment id is only used when no reference is given: several
+        transactions can share a WiPay id, e.g., a refund and its source payment.
+
+        :param str reference: The reference of the transaction.
+        :param str wipay_payment_id: The id of the transaction on WiPay's side.
+        :return: The matching transaction, if any.
+        :rtype: recordset of `payment.transaction`
+        """
+        dbname = self.env.cr.dbname
+        if reference:
+            key = (dbname, 'reference', reference)
+        elif wipay_payment_id:
+            key = (dbname, 'wipay_payment_id', wipay_payment_id)
+        else:
+            return self.browse()
+        tx_id = utils.tx_lookup_cache.get(key)
+        if tx_id:
+            tx = self.browse(tx_id).exists()
+            if tx:
+                return tx
+            utils.tx_lookup_cache.pop(key)
+
+        provider_ids = self.env['payment.provider']._wipay_get_provider_ids()
+        if reference:
+            domain = [('reference', '=', reference)]
+        else:
+            domain = [('wipay_payment_id', '=', wipay_payment_id)]
+        tx = self.search(domain + [('provider_id', 'in', provider_ids)], limit=1)
+        if tx:
+            tx._wipay_cache_lookup_keys()
+        return tx
+
+    def _wipay_cache_lookup_keys(self):
+        """ Remember the reference and the WiPay payment id of the transactions for `_wipay_lookup`.
+        """
+        dbname = self.env.cr.dbname
+        for tx in self:
+            utils.tx_lookup_cache.set((dbname, 'reference', tx.reference), tx.id)
+            if tx.wipay_payment_id:
+                utils.tx_lookup_cache.set((dbname, 'wipay_payment_id', tx.wipay_payment_id), tx.id)
+
+    @api.model
+    def _wipay_create_pay_transaction(
+        self, provider_id, amount, currency_id, partner_id, access_token, invoice_id=None,
+        prefix=None,
+    ):
+        """ Create the transaction of a payment request received on the WiPay pay route.
+
+        The request is validated in one go, as the standard payment routes do: the access token
+        must match the partner, the amount and the currency, and the invoice, if any, must be a
+        posted customer invoice of the partner in the same currency. The reference is taken from a
+        sequence rather than computed from the existing references, and the payment method is read
+        from the cached WiPay metadata, so that the transaction is created with a handful of
+        queries.
+
+        :param int provider_id: The provider of the transaction.
+        :param float amount: The amount to pay.
+        :param int currency_id: The currency of the amount.
+        :param int partner_id: The partner making the payment.
+        :param str access_token: The access token of the payment request.
+        :param int invoice_id: The invoice being paid, if any.
+        :param str prefix: The custom prefix of the reference, if any.
+        :return: The created transaction.
+        :rtype: recordset of `payment.transaction`
+        :raise ValidationError: If the payment request is invalid.
+        """
+        Provider = self.env['payment.provider']
+        try:
+            provider_id, currency_id = int(provider_id), int(currency_id)
+            partner_id, amount = int(partner_id), float(amount)
+            invoice_id = int(invoice_id) if invoice_id else None
+        except (TypeError, ValueError):
+            raise ValidationError("WiPay: " + _("Invalid payment request."))
+        if not payment_utils.check_access_token(access_token, partner_id, amount, currency_id):
+            raise ValidationError("WiPay: " + _("The access token is invalid."))
+        provider = Provider.browse(provider_id)
+        if (
+            provider_id not in Provider._wipay_get_provider_ids()
+            or provider.state == 'disabled'
+            or amount <= 0
+        ):
+            raise ValidationError("WiPay: " + _("Invalid payment request."))
+        if invoice_id:
+            invoice = self.env['account.move'].browse(invoice_id).exists()
+            partner = self.env['res.partner'].browse(partner_id)
+            if (
+                not invoice
+                or invoice.state != 'posted'
+                or not invoice.is_inbound()
+                or invoice.commercial_partner_id != partner.commercial_partner_id
+                or invoice.currency_id.id != currency_id
+            ):
+                raise ValidationError("WiPay: " + _("Invalid payment request."))
+
+        return self.create({
+            'provider_id': provider_id,
+            'payment_method_id': Provider._wipay_get_metadata(
+                provider.company_id.id
+            )['payment_method_id'],
+            'reference': self._wipay_get_pay_reference(prefix),
+            'amount': amount,
+            'currency_id': currency_id,
+            'partner_id': partner_id,
+            'operation': 'online_redirect',
+            'invoice_ids': [Command.set([invoice_id])] if invoice_id else None,
         })
-        return {
-            'provider_code': 'wipay',
-            'provider_name': self.provider_id.name,
-            'reference': self.reference,
-        }
+
+    @api.model
+    def _wipay_get_pay_reference(self, prefix=None):
+        """ Return a unique reference for a transaction of the pay route.
+
+        The number is taken from a sequence without gaps checks nor locks, unlike
+        `_compute_reference` which searches the existing references. The prefix comes from the
+        public request: like in `_compute_reference`, it is normalized to ASCII, and it is then
+        restricted to alphanumeric characters, dashes and underscores, and capped in length.
+
+        :param str prefix: The custom prefix of the reference, if any.
+        :return: The reference.
+        :rtype: str
+        """
+        if prefix:
+            prefix = unicodedata.normalize('NFKD', str(prefix)).encode('ascii', 'ignore').decode()
+            prefix = re.sub(r'[^A-Za-z0-9_-]', '', prefix)[:const.PAY_REFERENCE_PREFIX_MAX_LENGTH]
+        number = self.env.ref('payment_wipay.seq_wipay_pay_reference').sudo()._next()
+        return f'{prefix or const.PAY_REFERENCE_PREFIX}-{number}'
+
+    @api.model
+    def _wipay_ingest_notification(self, notification_data):
+        """ Process a webhook notification, or queue it if the WiPay provider is configured so.
+
+        :param dict notification_data: The notification data sent by WiPay.
+        :return: None
+        """
+        if self.env['payment.provider']._wipay_is_webhook_queued():
+            self.env['payment.wipay.notification'].sudo()._enqueue(notification_data)
+        else:
+            self._handle_notification_data('wipay', notification_data)
+
+    def _handle_notification_data(self, provider_code, notification_data):
+        """ Override of payment to skip the WiPay notifications that were already processed. """
+        if provider_code == 'wipay' and not self._wipay_register_notification(notification_data):
+            return self._get_tx_from_notification_data(provider_code, notification_data)
+        return super()._handle_notification_data(provider_code, notification_data)
+
+    def _wipay_register_notification(self, notification_data):
+        """ Record the notification in the idempotency ledger.
+
+        :param dict notification_data: The notification data sent by WiPay.
+        :return: Whether the notification was never processed before.
+        :rtype: bool
+        """
+        return self.env['payment.wipay.ledger'].sudo()._register(notification_data)
 
     def _process_notification_data(self, notification_data):
         super()._process_notification_data(notification_data)
@@ -157,42 +410,525 @@ class PaymentTransaction(models.Model):
 
         transaction_id = notification_data.get('transaction_id')
         payment_status = notification_data.get('status')
+        message = notification_data.get('message')
         received_signature = notification_data.get('signature')
 
         if received_signature and self.provider_id.wipay_secret_key:
-            signature_string = f"{self.provider_id.wipay_secret_key}{transaction_id}{self.reference}"
-            expected_signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
-            if received_signature != expected_signature:
+            with metrics.phase('signature', path='notification'):
+                is_valid = self.provider_id._wipay_verify_notification(
+                    received_signature, transaction_id, self.reference
+                )
+            if not is_valid:
                 _logger.warning("Received invalid signature from Wipay")
                 raise UserError(_("Wipay: Invalid signature received."))
 
-        self.wipay_payment_id = transaction_id
-        payment_method = self.env['payment.method'].search([('code', '=', 'wipay')], limit=1)
-        if not payment_method:
+        with metrics.phase('orm_write', path='notification'):
+            self._wipay_apply_status(transaction_id, payment_status, message)
+
+    def _wipay_apply_status(self, transaction_id, payment_status, message):
+        """ Save the WiPay payment id and move the transaction to the state matching the status. """
+        payment_method_id = self.env['payment.provider']._wipay_get_metadata(
+            self.company_id.id
+        )['payment_method_id']
+        if not payment_method_id:
             raise UserError(_("Wipay: Payment method not found."))
-        self.payment_method_id = payment_method.id
+        tx_values = {}
+        if self.wipay_payment_id != transaction_id:
+            tx_values['wipay_payment_id'] = transaction_id
+        if self.payment_method_id.id != payment_method_id:
+            tx_values['payment_method_id'] = payment_method_id
+        if tx_values:
+            self.write(tx_values)
+        self._wipay_cache_lookup_keys()
 
         if payment_status == 'success':
             self._set_done()
         elif payment_status == 'pending':
             self._set_pending()
         elif payment_status == 'failed':
-            self._set_canceled(_("Wipay: Payment failed."))
+            self._set_canceled(
+                _("Wipay: Payment failed: %s", message) if message else _("Wipay: Payment failed.")
+            )
         else:
             _logger.warning("Received unrecognized payment status from Wipay: %s", payment_status)
             self._set_error(_("Wipay: Received unrecognized payment status: %s") % payment_status)
 
-    def _generate_payment_vals_from_tx(self, tx):
-        vals = super()._generate_payment_vals_from_tx(tx)
-        if tx.provider_code == 'wipay':
-            journal = tx.acquirer_id.journal_id
-            method_line = tx.env['account.payment.method.line'].search([
-                ('journal_id', '=', journal.id),
-                ('payment_method_id.code', 'in', ['manual', 'electronic']),
-            ], limit=1)
-            if method_line:
-                vals['payment_method_line_id'] = method_line.id
+    # === POST-PROCESSING === #
+
+    def _cron_post_process(self):
+        """ Override of payment to post-process the backlog of WiPay transactions in batches. """
+        if not self:
+            self._wipay_post_process_backlog()
+        return super()._cron_post_process()
+
+    @api.model
+    def _wipay_post_process_backlog(self, batch_size=200, max_age_days=4):
+        """ Post-process the done WiPay transactions in batches, creating their payments in bulk.
+
+        Each batch is committed separately. If a batch fails, it is rolled back and its transactions
+        are post-processed one at a time; those that still fail are skipped for the rest of the run
+        and left to the standard post-processing.
+
+        :param int batch_size: The number of transactions post-processed per batch.
+        :param int max_age_days: The number of days after which transactions are no longer
+                                 post-processed, as in the standard post-processing.
+        :return: None
+        """
+        domain = [
+            ('provider_code', '=', 'wipay'),
+            ('state', '=', 'done'),
+            ('is_post_processed', '=', False),
+            ('last_state_change', '>=', fields.Datetime.now() - relativedelta(days=max_age_days)),
+        ]
+        failed_ids = []
+        while True:
+            batch = self.search(domain + [('id', 'not in', failed_ids)], limit=batch_size)
+            if not batch:
+                return
+            try:
+                batch._wipay_post_process_batch()
+            except Exception:  # noqa: BLE001 - retried one transaction at a time.
+                self.env.cr.rollback()
+                _logger.exception(
+                    "batched post-processing of %s WiPay transactions failed", len(batch)
+                )
+                for tx in batch:
+                    try:
+                        tx._wipay_post_process_batch()
+                    except Exception:  # noqa: BLE001 - left to the standard post-processing.
+                        self.env.cr.rollback()
+                        _logger.exception("post-processing of WiPay transaction %s failed", tx.id)
+                        failed_ids.append(tx.id)
+
+    def _wipay_post_process_batch(self):
+        """ Post-process the transactions, create their payments in bulk and commit. """
+        with metrics.phase('post_process', path='cron'):
+            self.with_context(wipay_defer_payment=True)._post_process()
+            self._wipay_create_payments()
+        self.env.cr.commit()
+
+    def _create_payment(self, **extra_create_values):
+        """ Override of account_payment to defer the creation of WiPay payments to the batch. """
+        if self.provider_code == 'wipay' and self.env.context.get('wipay_defer_payment'):
+            return self.env['account.payment']
+        return super()._create_payment(**extra_create_values)
+
+    def _wipay_create_payments(self):
+        """ Create, post and reconcile the missing payments of the transactions in bulk.
+
+        The payment method line of each journal is resolved once, the payments of each company
+        are created and posted at once, in that company, and each is then reconciled with the
+        invoices of its transaction. Transactions with invoices eligible for an early payment discount go
+        through the standard `_create_payment`, which computes the discount write-off.
+
+        :return: The created payments.
+        :rtype: recordset of `account.payment`
+        """
+        txs = self.filtered(lambda tx: (
+            tx.state == 'done'
+            and tx.operation != 'validation'
+            and not tx.payment_id
+            and not any(child.state in ('done', 'cancel') for child in tx.child_transaction_ids)
+        ))
+        with_discount = txs.filtered(
+            lambda tx: any(tx.invoice_ids.invoice_payment_term_id.mapped('early_discount'))
+        )
+        for tx in with_discount:
+            tx._create_payment()
+        txs -= with_discount
+        if not txs:
+            return self.env['account.payment']
+
+        method_line_ids = {}
+        for provider in txs.provider_id:
+            journal = provider.journal_id
+            method_line = journal.inbound_payment_method_line_ids.filtered(
+                lambda line: line.payment_provider_id == provider
+            )[:1]
+            method_line_ids[provider.id] = method_line.id or self.env[
+                'payment.provider'
+            ]._wipay_get_method_line_id(journal.id, ('manual', 'electronic'))
+            if not method_line_ids[provider.id]:
+                _logger.warning("No payment method line found for WiPay journal: %s", journal.name)
+
+        payments = self.env['account.payment']
+        for company, company_txs in txs.grouped('company_id').items():
+            payments |= company_txs._wipay_create_company_payments(company, method_line_ids)
+
+        reconciliations = []
+        for tx in txs:
+            payment = tx.payment_id
+            if tx.operation == tx.source_transaction_id.operation:
+                invoices = tx.source_transaction_id.invoice_ids
             else:
-                _logger.warning("⚠️ No payment method line found for WiPay journal: %s", journal.name)
-        return vals
+                invoices = tx.invoice_ids
+            reconciliations.append((payment, invoices.filtered(lambda inv: inv.state != 'cancel')))
+        all_invoices = self.env['account.move'].union(*(inv for _pay, inv in reconciliations))
+        all_invoices.filtered(lambda inv: inv.state == 'draft').action_post()
+        for payment, invoices in reconciliations:
+            if invoices:
+                (payment.move_id.line_ids + invoices.line_ids).filtered(
+                    lambda line: line.account_id == payment.destination_account_id
+                    and not line.reconciled
+                ).reconcile()
+        return payments
+
+    def _wipay_create_company_payments(self, company, method_line_ids):
+        """ Create and post the payments of transactions of a same company, in that company.
+
+        :param recordset company: The company of the transactions, as a `res.company` record.
+        :param dict method_line_ids: The payment method line to use, by provider id.
+        :return: The posted payments.
+        :rtype: recordset of `account.payment`
+        """
+        payments = self.env['account.payment'].with_company(company).create([{
+            'amount': abs(tx.amount),
+            'payment_type': 'inbound' if tx.amount > 0 else 'outbound',
+            'currency_id': tx.currency_id.id,
+            'partner_id': tx.partner_id.commercial_partner_id.id,
+            'partner_type': 'customer',
+            'journal_id': tx.provider_id.journal_id.id,
+            'company_id': tx.provider_id.company_id.id,
+            'payment_method_line_id': method_line_ids[tx.provider_id.id],
+            'payment_token_id': tx.token_id.id,
+            'payment_transaction_id': tx.id,
+            'memo': f'{tx.reference} - {tx.partner_id.display_name or ""} - '
+                    f'{tx.provider_reference or ""}',
+            'write_off_line_vals': [],
+            'invoice_ids': [Command.set(tx.invoice_ids.ids)],
+        } for tx in self])
+        payments.action_post()
+        for tx, payment in zip(self, payments):
+            tx.payment_id = payment
+        return payments.with_env(self.env)
+
+    # === METRICS === #
+
+    @api.model
+    def _wipay_get_metric_gauges(self):
+        """ Return the queue, ledger and reconciliation statistics to expose as metrics.
+
+        :return: The values of the gauges, by name.
+        :rtype: dict
+        """
+        queue_stats = self.env['payment.wipay.notification'].sudo()._get_queue_stats()
+        ledger_stats = self.env['payment.wipay.ledger'].sudo()._get_ledger_stats()
+        gauges = {
+            'wipay_queue_depth': queue_stats['depth'],
+            'wipay_queue_batches': queue_stats['batches'],
+            'wipay_queue_processed': queue_stats['processed'],
+            'wipay_queue_errors': queue_stats['errors'],
+            'wipay_queue_last_batch_throughput': queue_stats['last_batch_throughput'],
+            'wipay_duplicates_suppressed': ledger_stats['suppressed'],
+            'wipay_duplicates_suppressed_last_day': ledger_stats['suppressed_last_day'],
+        }
+        reconcile_stats = self.env['payment.wipay.stats'].sudo()._get('reconcile', RECONCILE_STATS)
+        gauges.update({
+            f'wipay_reconcile_{name}': value for name, value in reconcile_stats.items()
+        })
+        return gauges
+
+    # === REFUNDS === #
+
+    def _send_refund_request(self, amount_to_refund=None):
+        """ Override of payment to send a refund request to WiPay.
+
+        Note: self.ensure_one()
+
+        If the context key `wipay_defer_refund` is set, the refund transaction is only created and
+        it is up to the caller to submit it with `_wipay_submit_refunds`.
+
+        :param float amount_to_refund: The amount to refund.
+        :return: The refund transaction created to process the refund request.
+        :rtype: recordset of `payment.transaction`
+        """
+        refund_tx = super()._send_refund_request(amount_to_refund=amount_to_refund)
+        if self.provider_code != 'wipay' or self.env.context.get('wipay_defer_refund'):
+            return refund_tx
+
+        refund_tx._wipay_submit_refunds()
+        return refund_tx
+
+    def _wipay_refund_batch(self, amount_to_refund=None, max_workers=8):
+        """ Refund the transactions with concurrent requests to WiPay.
+
+        Each transaction is refunded at most by its remaining refundable amount; the transactions
+        with nothing left to refund are skipped.
+
+        :param float amount_to_refund: The amount to refund for each transaction; the remaining
+                                       refundable amount if not set.
+        :param int max_workers: The maximum number of concurrent requests.
+        :return: The summary of the refunds; see `_wipay_submit_refunds`.
+        :rtype: dict
+        """
+        refund_txs = self.browse()
+        skipped = 0
+        for tx in self.filtered(lambda t: t.provider_code == 'wipay'):
+            refundable_amount = tx._wipay_get_refundable_amount()
+            if amount_to_refund:
+                refundable_amount = min(amount_to_refund, refundable_amount)
+            if tx.currency_id.compare_amounts(refundable_amount, 0) <= 0:
+                skipped += 1
+                continue
+            refund_txs |= tx.with_context(wipay_defer_refund=True)._send_refund_request(
+                amount_to_refund=refundable_amount
+            )
+        summary = refund_txs.with_context(wipay_defer_refund=False)._wipay_submit_refunds(
+            max_workers=max_workers
+        )
+        summary['skipped'] = skipped
+        return summary
 
+    def _wipay_get_refundable_amount(self):
+        """ Return the amount of the transaction that is not refunded nor being refunded yet.
+
+        Note: self.ensure_one()
+
+        :return: The remaining refundable amount.
+        :rtype: float
+        """
+        self.ensure_one()
+        refund_txs = self.child_transaction_ids.filtered(
+            lambda tx: tx.operation == 'refund' and tx.state not in ('cancel', 'error')
+        )
+        return self.amount + sum(refund_txs.mapped('amount'))  # Refund amounts are negative.
+
+    def _wipay_get_refund_amount(self):
+        """ Return the amount to refund in the WiPay currency, derived from the charged total.
+
+        The amount is the share of the total charged by WiPay for the source payment that the
+        refund covers, so that the customer is refunded what they paid whatever the conversion rate
+        of the day. The last refund of a payment returns whatever remains of the charged total.
+
+        Note: self.ensure_one()
+
+        :return: The amount to refund, in the WiPay currency.
+        :rtype: float
+        """
+        self.ensure_one()
+        provider = self.provider_id
+        source_tx = self.source_transaction_id
+        charged_amount = source_tx.wipay_amount or provider._wipay_convert_amount(
+            source_tx.amount, source_tx.currency_id, date=source_tx.create_date.date()
+        )
+        if source_tx.currency_id.is_zero(source_tx._wipay_get_refundable_amount()):
+            other_refund_txs = source_tx.child_transaction_ids.filtered(
+                lambda tx: tx.operation == 'refund' and tx != self
+                and tx.state not in ('cancel', 'error')
+            )
+            return round(charged_amount - sum(other_refund_txs.mapped('wipay_amount')), 2)
+        return round(charged_amount * -self.amount / source_tx.amount, 2)
+
+    def _wipay_submit_refunds(self, max_workers=8):
+        """ Submit the refund transactions to WiPay concurrently and apply the responses.
+
+        A request is only retried if it never reached WiPay, so that no refund is paid twice. The
+        refund transactions that WiPay rejected, or that could not be sent, are set in error; those
+        whose outcome is unknown, e.g., after a read timeout, are left pending to be checked in
+        WiPay's dashboard.
+
+        :param int max_workers: The maximum number of concurrent requests.
+        :return: The number of submitted refunds per resulting state, the references of the failed
+                 refunds with their error and the duration of the batch.
+        :rtype: dict
+        """
+        calls = []
+        for refund_tx in self:
+            provider = refund_tx.provider_id
+            source_tx = refund_tx.source_transaction_id
+            amount = refund_tx._wipay_get_refund_amount()
+            refund_tx.wipay_amount = amount
+            payload = {
+                'account_number': provider.wipay_merchant_account_id,
+                'transaction_id': source_tx.wipay_payment_id or source_tx.provider_reference,
+                'order_id': refund_tx.reference,
+                'amount': f"{amount:.2f}",
+                'currency': provider.wipay_currency,
+            }
+            spec = provider._wipay_get_request_spec()
+            url = provider._wipay_get_api_url('refund')
+            calls.append((refund_tx, url, lambda spec=spec, url=url, payload=payload: (
+                utils.send_request_with_retries(spec, url, payload=payload)
+            )))
+
+        summary = {'submitted': len(self), 'done': 0, 'pending': 0, 'error': 0, 'errors': {}}
+        with utils.Timer() as timer:
+            results = utils.map_concurrently(calls, max_workers=max_workers)
+        for refund_tx, response_data, error in results:
+            if not error and response_data.get('status') not in ('success', 'pending'):
+                error = response_data.get('message') or _("Unknown error")
+            # WiPay may have paid the refund if the request was sent and not answered with a 4xx.
+            outcome_unknown = isinstance(error, requests.exceptions.RequestException) and not (
+                utils.is_unsent_error(error)
+                or (error.response is not None and error.response.status_code < 500)
+            )
+            if outcome_unknown:
+                _logger.warning(
+                    "The outcome of WiPay refund %s is unknown: %s", refund_tx.reference, error
+                )
+                refund_tx._set_pending(_(
+                    "Wipay: The outcome of the refund request is unknown (%s). Check the refund "
+                    "in WiPay's dashboard before submitting it again.", error,
+                ))
+                summary['pending'] += 1
+                summary['errors'][refund_tx.reference] = str(error)
+                continue
+            if error:
+                _logger.warning("WiPay refund %s failed: %s", refund_tx.reference, error)
+                refund_tx._set_error(_("Wipay: The refund request failed: %s", error))
+                summary['error'] += 1
+                summary['errors'][refund_tx.reference] = str(error)
+                continue
+            # The response echoes the WiPay id of the source payment: it is not a notification of
+            # the refund transaction and is applied as is.
+            if response_data['status'] == 'success':
+                refund_tx._set_done()
+                summary['done'] += 1
+            else:
+                refund_tx._set_pending()
+                summary['pending'] += 1
+        summary['duration'] = timer.duration
+        _logger.info(
+            "Submitted %(submitted)s WiPay refunds in %(duration).3fs: %(done)s done, "
+            "%(pending)s pending, %(error)s failed", summary,
+        )
+        return summary
+
+    def action_wipay_refund(self):
+        """ Refund what remains of the selected WiPay transactions and report the outcome. """
+        txs = self.filtered(lambda t: t.provider_code == 'wipay' and t.state == 'done'
+                            and t.operation != 'refund')
+        if not txs:
+            raise UserError(_("Wipay: Select at least one confirmed WiPay payment to refund."))
+        summary = txs._wipay_refund_batch()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _("WiPay Refunds"),
+                'message': _(
+                    "%(done)s refunds done, %(pending)s pending and %(error)s failed; "
+                    "%(skipped)s payments had nothing left to refund.",
+                    **summary,
+                ),
+                'type': 'warning' if summary['error'] else 'success',
+                'sticky': bool(summary['error']),
+            },
+        }
+
+    # === RECONCILIATION === #
+
+    @api.model
+    def _cron_wipay_reconcile_pending(
+        self, stale_minutes=30, max_age_days=4, chunk_size=100, max_workers=8, per_host_limit=4
+    ):
+        """ Query WiPay for the status of the transactions that never received a notification.
+
+        Only the transactions submitted to WiPay, i.e., with a WiPay payment id, are reconciled: the
+        others never reached WiPay and have no status to fetch. The cron is inactive by default, as
+        the status endpoint is not part of the published WiPay API.
+
+        Stale draft and pending WiPay transactions are processed in chunks; the status of the
+        transactions of a chunk is fetched concurrently in a bounded thread pool and the results are
+        applied through `_process_notification_data` on the cron thread. Each chunk is committed
+        separately.
+
+        :param int stale_minutes: The age after which a transaction without notification is stale.
+        :param int max_age_days: The age after which a transaction is no longer reconciled.
+        :param int chunk_size: The number of transactions processed per chunk.
+        :param int max_workers: The maximum number of concurrent requests.
+        :param int per_host_limit: The maximum number of concurrent requests to a same WiPay host.
+        :return: The number of reconciled transactions.
+        :rtype: int
+        """
+        now = fields.Datetime.now()
+        txs = self.sudo().search([
+            ('provider_id', 'in', self.env['payment.provider']._wipay_get_provider_ids()),
+            ('state', 'in', const.RECONCILABLE_STATES),
+            ('wipay_payment_id', '!=', False),
+            ('create_date', '<=', now - relativedelta(minutes=stale_minutes)),
+            ('create_date', '>=', now - relativedelta(days=max_age_days)),
+        ], order='id')
+
+        checked = reconciled = errors = 0
+        with utils.Timer() as timer:
+            for tx_ids in split_every(chunk_size, txs.ids):
+                chunk = self.sudo().browse(tx_ids)
+                chunk_reconciled, chunk_errors = chunk._wipay_reconcile(
+                    max_workers=max_workers, per_host_limit=per_host_limit
+                )
+                self.env.cr.commit()
+                checked += len(chunk)
+                reconciled += chunk_reconciled
+                errors += chunk_errors
+
+        throughput = reconciled / timer.duration if timer.duration else 0.0
+        self.env['payment.wipay.stats'].sudo()._record(
+            'reconcile',
+            {'runs': 1, 'checked': checked, 'reconciled': reconciled, 'errors': errors},
+            {'last_run_duration': timer.duration, 'last_run_throughput': throughput},
+        )
+        if checked:
+            _logger.info(
+                "Reconciled %s of %s pending WiPay transactions in %.3fs (%.1f/s, %s errors)",
+                reconciled, checked, timer.duration, throughput, errors,
+            )
+        return reconciled
+
+    def _wipay_reconcile(self, max_workers=8, per_host_limit=4):
+        """ Fetch the status of the transactions from WiPay and apply it.
+
+        :param int max_workers: The maximum number of concurrent requests.
+        :param int per_host_limit: The maximum number of concurrent requests to a same WiPay host.
+        :return: The number of transactions whose state changed and the number of errors.
+        :rtype: tuple
+        """
+        calls = []
+        specs = {}
+        for tx in self:
+            provider = tx.provider_id
+            if provider not in specs:
+                specs[provider] = (
+                    provider._wipay_get_request_spec(), provider._wipay_get_api_url('status')
+                )
+            spec, url = specs[provider]
+            payload = {
+                'account_number': provider.wipay_merchant_account_id,
+                'order_id': tx.reference,
+                'transaction_id': tx.wipay_payment_id,
+            }
+            calls.append((tx, url, lambda spec=spec, url=url, payload=payload: utils.send_request(
+                spec, url, payload=payload, method='GET'
+            )))
+
+        reconciled = errors = 0
+        for tx, response_data, error in utils.map_concurrently(
+            calls, max_workers=max_workers, per_host_limit=per_host_limit
+        ):
+            if error:
+                _logger.warning("Unable to fetch the status of %s from WiPay: %s", tx.reference, error)
+                errors += 1
+                continue
+            notification_data = {
+                'order_id': tx.reference,
+                'transaction_id': tx.wipay_payment_id,
+                **(response_data or {}),
+            }
+            status = notification_data.get('status')
+            if status not in ('success', 'failed', 'pending') or (
+                status == 'pending' and tx.state == 'pending'
+            ):
+                continue  # Unknown to WiPay or still pending on its side.
+            state = tx.state
+            try:
+                with self.env.cr.savepoint():
+                    if tx._wipay_register_notification(notification_data):
+                        tx._process_notification_data(notification_data)
+                        tx._execute_callback()
+            except (UserError, ValidationError) as error:
+                _logger.warning("Unable to reconcile %s with WiPay: %s", tx.reference, error)
+                errors += 1
+                continue
+            if tx.state != state:
+                reconciled += 1
+        return reconciled, errors
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from urllib.parse import urlparse
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_wipay import utils
+
+_logger = logging.getLogger(__name__)
+
+# Per-worker cache of the routing table, refreshed after `ROUTING_TABLE_TTL` seconds.
+ROUTING_TABLE_TTL = 30
+_routing_cache = utils.LookupCache(max_size=100, ttl=ROUTING_TABLE_TTL)
+
+
+class PaymentWipayEndpoint(models.Model):
+    _name = 'payment.wipay.endpoint'
+    _description = "WiPay Regional Endpoint"
+    _order = 'region'
+
+    region = fields.Selection(
+        string="Region",
+        selection=[('tt', "Trinidad and Tobago"), ('jm', "Jamaica")],
+        required=True,
+    )
+    url = fields.Char(string="Base URL", required=True)
+    is_healthy = fields.Boolean(string="Healthy", default=True, readonly=True)
+    latency_ms = fields.Float(string="Latency (ms)", readonly=True)
+    failure_count = fields.Integer(
+        string="Consecutive Failures",
+        help="The number of consecutive failed health probes",
+        readonly=True,
+    )
+    last_probe_date = fields.Datetime(string="Last Probe", readonly=True)
+    last_error = fields.Char(string="Last Error", readonly=True)
+
+    _sql_constraints = [
+        ('region_uniq', 'unique(region)', "There can only be one endpoint per WiPay region."),
+    ]
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _get_routing_table(self):
+        """ Return the base URL, health and latency of each region, cached per worker.
+
+        :return: The (url, is_healthy, latency_ms) tuple of each region, by region.
+        :rtype: dict
+        """
+        key = self.env.cr.dbname
+        table = _routing_cache.get(key)
+        if table is None:
+            table = {
+                endpoint['region']: (
+                    endpoint['url'], endpoint['is_healthy'], endpoint['latency_ms']
+                )
+                for endpoint in self.sudo().search_read(
+                    [], ['region', 'url', 'is_healthy', 'latency_ms']
+                )
+            }
+            _routing_cache.set(key, table)
+        return table
+
+    @api.model
+    def _select_region(self, regions):
+        """ Return the fastest healthy region among the eligible ones.
+
+        A region is healthy if its last probe succeeded and the circuit breaker of its host is
+        closed in this worker. If no eligible region is healthy, the first one is returned so that
+        the call fails fast or serves as the trial call of the circuit breaker.
+
+        :param tuple regions: The eligible regions, by order of preference.
+        :return: The selected region and its base URL.
+        :rtype: tuple
+        """
+        table = self._get_routing_table()
+        candidates = [
+            (table[region][2] or 0.0, index, region)
+            for index, region in enumerate(regions)
+            if region in table
+            and table[region][1]
+            and not utils.get_breaker(urlparse(table[region][0]).netloc).is_open
+        ]
+        if candidates:
+            region = min(candidates)[2]
+        else:
+            region = next((region for region in regions if region in table), regions[0])
+        return region, table.get(region, ('',))[0]
+
+    @api.model
+    def _cron_probe_endpoints(self, timeout=5.0, failure_threshold=3):
+        """ Probe the health and latency of every regional endpoint concurrently.
+
+        An endpoint is marked unhealthy after `failure_threshold` consecutive failed probes, and
+        healthy again after the first successful one.
+
+        :param float timeout: The timeout of each probe, in seconds.
+        :param int failure_threshold: The number of consecutive failures marking an endpoint down.
+        :return: None
+        """
+        endpoints = self.sudo().search([])
+        calls = []
+        for endpoint in endpoints:
+            key = (self.env.cr.dbname, f'probe:{endpoint.region}')
+            spec = utils.RequestSpec(
+                key=key,
+                session=utils.get_session(key, 0),
+                headers={'Accept': 'application/json'},
+                timeout=timeout,
+            )
+            calls.append((endpoint, endpoint.url, lambda spec=spec, url=endpoint.url: (
+                utils.send_probe(spec, url)
+            )))
+
+        now = fields.Datetime.now()
+        for endpoint, duration, error in utils.map_concurrently(calls):
+            if error:
+                failure_count = endpoint.failure_count + 1
+                _logger.warning("WiPay endpoint %s failed its health probe: %s", endpoint.url, error)
+                endpoint.write({
+                    'is_healthy': failure_count < failure_threshold,
+                    'failure_count': failure_count,
+                    'last_probe_date': now,
+                    'last_error': str(error)[:255],
+                })
+            else:
+                endpoint.write({
+                    'is_healthy': True,
+                    'latency_ms': duration * 1000,
+                    'failure_count': 0,
+                    'last_probe_date': now,
+                    'last_error': False,
+                })
+        _routing_cache.clear()
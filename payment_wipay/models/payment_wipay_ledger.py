@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_wipay import const, logging_utils
+
+# Per-worker counter of the duplicate notifications that were suppressed.
+LEDGER_STATS = {
+    'suppressed': 0,
+}
+
+
+class PaymentWipayLedger(models.Model):
+    _name = 'payment.wipay.ledger'
+    _description = "WiPay Notification Idempotency Ledger"
+    _order = 'id desc'
+    _log_access = False
+
+    # The key columns hold an empty string rather than NULL when the value is missing, so that the
+    # unique constraint applies to them.
+    reference = fields.Char(string="Reference", readonly=True)
+    wipay_transaction_id = fields.Char(string="WiPay Transaction ID", readonly=True)
+    status = fields.Char(string="Status", readonly=True)
+    duplicate_count = fields.Integer(
+        string="Duplicates",
+        help="The number of times the same notification was received again and ignored",
+        readonly=True,
+    )
+    received_date = fields.Datetime(
+        string="Received On", readonly=True, default=fields.Datetime.now, index=True
+    )
+
+    _sql_constraints = [(
+        'transaction_status_uniq',
+        'unique(reference, wipay_transaction_id, status)',
+        "A WiPay notification can only be recorded once per reference, transaction and status.",
+    )]
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _register(self, notification_data):
+        """ Record the notification in the ledger and return whether it was seen for the first time.
+
+        The insertion is made with a single upsert so that concurrent deliveries of the same
+        notification (e.g., the customer return and the webhook) are serialized on the ledger row
+        rather than on the transaction, and that a duplicate only costs one statement.
+
+        Note: the ledger entry is part of the current transaction; if the processing of the
+        notification fails and is rolled back, the notification can be processed again.
+
+        :param dict notification_data: The notification data sent by WiPay.
+        :return: Whether the notification must be processed.
+        :rtype: bool
+        """
+        key = (
+            str(notification_data.get('order_id') or ''),
+            str(notification_data.get('transaction_id') or ''),
+            str(notification_data.get('status') or ''),
+        )
+        if not any(key[:2]):
+            return True
+
+        self.env.cr.execute("""
+            INSERT INTO payment_wipay_ledger
+                   (reference, wipay_transaction_id, status, duplicate_count, received_date)
+            VALUES (%s, %s, %s, 0, NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (reference, wipay_transaction_id, status)
+            DO UPDATE SET duplicate_count = payment_wipay_ledger.duplicate_count + 1
+            RETURNING duplicate_count
+        """, key)
+        is_new = self.env.cr.fetchone()[0] == 0
+        if not is_new:
+            LEDGER_STATS['suppressed'] += 1
+            logging_utils.log_event(
+                'notification.duplicate', reference=key[0], transaction_id=key[1], status=key[2]
+            )
+        return is_new
+
+    @api.model
+    def _get_ledger_stats(self):
+        """ Return the number of duplicate notifications suppressed by this worker and, overall,
+        over the last day.
+
+        :return: The ledger statistics.
+        :rtype: dict
+        """
+        self.env.cr.execute("""
+            SELECT COALESCE(SUM(duplicate_count), 0)
+              FROM payment_wipay_ledger
+             WHERE received_date >= %s
+        """, [fields.Datetime.now() - relativedelta(days=1)])
+        return {
+            'suppressed': LEDGER_STATS['suppressed'],
+            'suppressed_last_day': self.env.cr.fetchone()[0],
+        }
+
+    @api.autovacuum
+    def _gc_ledger(self):
+        """ Delete the entries of the notifications received before the retention period. """
+        self.env.cr.execute(
+            "DELETE FROM payment_wipay_ledger WHERE received_date < %s",
+            [fields.Datetime.now() - relativedelta(days=const.LEDGER_RETENTION_DAYS)],
+        )
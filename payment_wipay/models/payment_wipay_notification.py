@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import json
+import logging
+import os
+from collections import defaultdict
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import config
+
+from odoo.addons.payment_wipay import const, utils
+
+_logger = logging.getLogger(__name__)
+
+# The default statistics of the notification queue, before its first batch.
+QUEUE_STATS = {
+    'batches': 0,
+    'processed': 0,
+    'errors': 0,
+    'last_batch_size': 0,
+    'last_batch_duration': 0.0,
+    'last_batch_throughput': 0.0,
+}
+
+
+class PaymentWipayNotification(models.Model):
+    _name = 'payment.wipay.notification'
+    _description = "WiPay Notification Queue"
+    _order = 'id'
+    _log_access = False
+
+    reference = fields.Char(string="Reference", readonly=True, index=True)
+    payload = fields.Json(string="Payload", readonly=True)
+    received_date = fields.Datetime(
+        string="Received On", readonly=True, default=fields.Datetime.now
+    )
+    state = fields.Selection(
+        string="Status",
+        selection=[('pending', "Pending"), ('done', "Done"), ('error', "Error")],
+        required=True,
+        default='pending',
+        index=True,
+    )
+    error_message = fields.Char(string="Error Message", readonly=True)
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _enqueue(self, notification_data):
+        """ Persist a raw WiPay notification and wake up the queue processor.
+
+        The processor is only triggered by the first notification of a burst, i.e., if no other
+        notification is pending: it drains the whole queue once started, and triggers itself again
+        if needed. A notification queued while a run completes is processed by the next scheduled
+        run.
+
+        :param dict notification_data: The notification data sent by WiPay.
+        :return: The queued notification.
+        :rtype: recordset of `payment.wipay.notification`
+        """
+        burst_started = not self.search_count([('state', '=', 'pending')], limit=1)
+        notification = self.create({
+            'reference': notification_data.get('order_id'),
+            'payload': notification_data,
+        })
+        if burst_started:
+            self.env.ref('payment_wipay.cron_process_wipay_notifications')._trigger()
+        return notification
+
+    @api.model
+    def _cron_process_notifications(self, batch_size=500, max_batches=20):
+        """ Drain the queue of pending notifications in batches.
+
+        Each batch is committed separately. If notifications are still pending after `max_batches`
+        batches, the cron is triggered again to leave the worker to other jobs in between.
+
+        :param int batch_size: The number of notifications processed per batch.
+        :param int max_batches: The maximum number of batches processed per run.
+        :return: None
+        """
+        for _i in range(max_batches):
+            batch = self.search([('state', '=', 'pending')], limit=batch_size)
+            if not batch:
+                return
+            with utils.Timer() as timer:
+                errors = batch._process_batch()
+            self.env.cr.commit()
+            self._record_batch_stats(len(batch), errors, timer.duration)
+
+        if self.search_count([('state', '=', 'pending')], limit=1):
+            self.env.ref('payment_wipay.cron_process_wipay_notifications')._trigger()
+
+    def _process_batch(self):
+        """ Apply the notifications of the batch to their transactions.
+
+        The notifications are grouped by reference and the matching transactions are fetched with a
+        single query. Notifications of the same transaction are applied in the order they were
+        received.
+
+        :return: The number of notifications that could not be applied.
+        :rtype: int
+        """
+        notifications_by_reference = defaultdict(lambda: self.browse())
+        for notification in self:
+            notifications_by_reference[notification.reference] |= notification
+
+        txs = self.env['payment.transaction'].sudo().search([
+            ('reference', 'in', [ref for ref in notifications_by_reference if ref]),
+            ('provider_id', 'in', self.env['payment.provider']._wipay_get_provider_ids()),
+        ])
+        tx_by_reference = {tx.reference: tx for tx in txs}
+
+        processed = self.browse()
+        for reference, notifications in notifications_by_reference.items():
+            tx = tx_by_reference.get(reference)
+            if not tx:
+                notifications.write({
+                    'state': 'error',
+                    'error_message': "No transaction found matching reference %s." % reference,
+                })
+                continue
+            for notification in notifications:
+                try:
+                    with self.env.cr.savepoint():
+                        if tx._wipay_register_notification(notification.payload):
+                            tx._process_notification_data(notification.payload)
+                            tx._execute_callback()
+                    processed |= notification
+                except (UserError, ValidationError) as error:
+                    _logger.warning(
+                        "Unable to process queued WiPay notification %s for %s: %s",
+                        notification.id, reference, error,
+                    )
+                    notification.write({'state': 'error', 'error_message': str(error)})
+        processed.write({'state': 'done'})
+        return len(self) - len(processed)
+
+    def _verify_signatures(self):
+        """ Return the notifications whose signature does not match their transaction.
+
+        The transactions are fetched with a single query and the signatures are checked with the
+        precomputed key material of their provider. Notifications without transaction or signature
+        are left to `_process_batch`.
+
+        :return: The notifications with an invalid signature.
+        :rtype: recordset of `payment.wipay.notification`
+        """
+        txs = self.env['payment.transaction'].sudo().search([
+            ('reference', 'in', [ref for ref in self.mapped('reference') if ref]),
+            ('provider_id', 'in', self.env['payment.provider']._wipay_get_provider_ids()),
+        ])
+        tx_by_reference = {tx.reference: tx for tx in txs}
+        invalid = self.browse()
+        for notification in self:
+            tx = tx_by_reference.get(notification.reference)
+            received_signature = notification.payload.get('signature')
+            if (
+                tx and received_signature and tx.provider_id.wipay_secret_key
+                and not tx.provider_id._wipay_verify_notification(
+                    received_signature, notification.payload.get('transaction_id'), tx.reference
+                )
+            ):
+                invalid |= notification
+        return invalid
+
+    @api.model
+    def _replay(self, stream, chunk_size=500):
+        """ Apply the notifications of a JSON Lines export, e.g., to recover from a downtime.
+
+        The file is streamed in chunks of `chunk_size` notifications. The notifications of each
+        chunk are queued, verified in bulk, applied with `_process_batch` and committed, so that an
+        interrupted replay can be resumed: already applied notifications are suppressed by the
+        ledger.
+
+        :param stream: The export, as a text file object with one JSON payload per line.
+        :param int chunk_size: The number of notifications applied per transaction.
+        :return: The number of notifications read, applied, rejected because of an invalid
+                 signature, and in error.
+        :rtype: dict
+        """
+        summary = {'read': 0, 'applied': 0, 'invalid': 0, 'errors': 0}
+        lines = (line for line in stream if line.strip())
+        while chunk := list(itertools.islice(lines, chunk_size)):
+            values_list = []
+            for line in chunk:
+                try:
+                    payload = json.loads(line)
+                except ValueError:
+                    payload = None
+                if not isinstance(payload, dict):
+                    summary['errors'] += 1
+                    continue
+                values_list.append({'reference': payload.get('order_id'), 'payload': payload})
+            summary['read'] += len(chunk)
+
+            with utils.Timer() as timer:
+                notifications = self.create(values_list)
+                invalid = notifications._verify_signatures()
+                invalid.write({'state': 'error', 'error_message': "Invalid signature."})
+                errors = (notifications - invalid)._process_batch()
+            self.env.cr.commit()
+            self._record_batch_stats(len(notifications), errors + len(invalid), timer.duration)
+            summary['invalid'] += len(invalid)
+            summary['errors'] += errors
+            summary['applied'] += len(notifications) - len(invalid) - errors
+        _logger.info("replayed WiPay notifications: %s", summary)
+        return summary
+
+    @api.model
+    def _cron_replay_notifications(self):
+        """ Replay the notification exports dropped in the replay directory.
+
+        The directory is set with the `wipay_replay_dir` option of the Odoo configuration file.
+        Exports are moved to its `done` subdirectory once replayed.
+
+        :return: None
+        """
+        directory = config.get('wipay_replay_dir')
+        if not directory or not os.path.isdir(directory):
+            return
+        done_directory = os.path.join(directory, 'done')
+        os.makedirs(done_directory, exist_ok=True)
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.jsonl'):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path, encoding='utf-8') as stream:
+                self._replay(stream)
+            os.replace(path, os.path.join(done_directory, filename))
+
+    @api.model
+    def _record_batch_stats(self, size, errors, duration):
+        throughput = size / duration if duration else 0.0
+        self.env['payment.wipay.stats'].sudo()._record(
+            'queue',
+            {'batches': 1, 'processed': size - errors, 'errors': errors},
+            {
+                'last_batch_size': size,
+                'last_batch_duration': duration,
+                'last_batch_throughput': throughput,
+            },
+        )
+        _logger.info(
+            "Processed a batch of %s WiPay notifications in %.3fs (%.1f/s)",
+            size, duration, throughput,
+        )
+
+    @api.model
+    def _get_queue_stats(self):
+        """ Return the depth of the queue and its throughput counters, shared by all workers.
+
+        :return: The queue statistics.
+        :rtype: dict
+        """
+        return dict(
+            self.env['payment.wipay.stats'].sudo()._get('queue', QUEUE_STATS),
+            depth=self.search_count([('state', '=', 'pending')]),
+        )
+
+    @api.autovacuum
+    def _gc_processed_notifications(self):
+        """ Delete the processed notifications, and the customer data of their payload, once the
+        retention period is over. """
+        self.env.cr.execute("""
+            DELETE FROM payment_wipay_notification
+             WHERE state IN ('done', 'error') AND received_date < %s
+        """, [fields.Datetime.now() - relativedelta(days=const.NOTIFICATION_RETENTION_DAYS)])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from dateutil.relativedelta import relativedelta
+from psycopg2 import OperationalError
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_wipay import const, metrics
+
+_logger = logging.getLogger(__name__)
+
+
+class PaymentWipayRateLimit(models.Model):
+    _name = 'payment.wipay.rate.limit'
+    _description = "WiPay Rate Limit Bucket"
+    _log_access = False
+
+    key = fields.Char(string="Key", required=True, readonly=True)
+    tokens = fields.Float(string="Tokens", readonly=True)
+    updated_at = fields.Datetime(string="Updated On", readonly=True)
+
+    _sql_constraints = [
+        ('key_uniq', 'unique(key)', "There can only be one rate limit bucket per key."),
+    ]
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _get_route_limit(self, route):
+        """ Return the burst and the refills per minute of the rate limit of a route.
+
+        :param str route: The route, as a key of `const.RATE_LIMITS`.
+        :return: The (burst, refills per minute) tuple, or None if the route is not limited.
+        :rtype: tuple
+        """
+        value = self.env['ir.config_parameter'].sudo().get_param(
+            f'payment_wipay.rate_limit.{route}'
+        )
+        if not value:
+            return const.RATE_LIMITS.get(route)
+        try:
+            burst, _sep, per_minute = value.partition('/')
+            limit = int(burst), float(per_minute or burst)
+        except ValueError:
+            _logger.warning("invalid WiPay rate limit for route %s: %s", route, value)
+            return const.RATE_LIMITS.get(route)
+        return limit if limit[0] > 0 else None
+
+    @api.model
+    def _consume(self, route, keys):
+        """ Take a token from the bucket of each key and return how long to wait if one is empty.
+
+        The buckets are shared by all workers. Each one is refilled and decremented by a single
+        upsert, made in a separate READ COMMITTED transaction that is committed at once. The
+        current transaction is thus never rolled back because of concurrent requests, and does not
+        hold the locks of the buckets while it is processed.
+
+        If the database cannot be reached, the request is let through. In test mode, the cursor
+        shares the transaction of the test, whose isolation level cannot be changed anymore.
+
+        :param str route: The route, as a key of `const.RATE_LIMITS`.
+        :param list keys: The keys identifying the caller, e.g., `ip:127.0.0.1`.
+        :return: The number of seconds before a token is available, or 0 if the request can be
+                 processed.
+        :rtype: float
+        """
+        limit = self._get_route_limit(route)
+        if not limit or not keys:
+            return 0
+        burst, per_minute = limit
+        rate = per_minute / 60
+        try:
+            with self.env.registry.cursor() as cr:
+                if not self.env.registry.in_test_mode():
+                    cr.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+                for key in keys:
+                    cr.execute("""
+                        INSERT INTO payment_wipay_rate_limit AS bucket (key, tokens, updated_at)
+                        VALUES (%(key)s, %(burst)s - 1, NOW() AT TIME ZONE 'UTC')
+                        ON CONFLICT (key) DO UPDATE
+                           SET tokens = LEAST(
+                                   %(burst)s,
+                                   bucket.tokens + %(rate)s * EXTRACT(
+                                       EPOCH FROM (NOW() AT TIME ZONE 'UTC') - bucket.updated_at
+                                   )
+                               ) - 1,
+                               updated_at = NOW() AT TIME ZONE 'UTC'
+                         WHERE LEAST(
+                                   %(burst)s,
+                                   bucket.tokens + %(rate)s * EXTRACT(
+                                       EPOCH FROM (NOW() AT TIME ZONE 'UTC') - bucket.updated_at
+                                   )
+                               ) >= 1
+                        RETURNING tokens
+                    """, {'key': f'{route}:{key}', 'burst': burst, 'rate': rate})
+                    if not cr.rowcount:
+                        metrics.inc('wipay_rate_limited_total', route=route, key=key.split(':')[0])
+                        return 1 / rate if rate else 60
+        except OperationalError:
+            _logger.warning(
+                "unable to apply the WiPay rate limit of route %s", route, exc_info=True
+            )
+        return 0
+
+    @api.autovacuum
+    def _gc_idle_buckets(self):
+        """ Delete the buckets that have been refilled for long enough to be full again. """
+        self.env.cr.execute(
+            "DELETE FROM payment_wipay_rate_limit WHERE updated_at < %s",
+            [fields.Datetime.now() - relativedelta(days=1)],
+        )
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_wipay import const
+
+
+class PaymentWipaySession(models.Model):
+    _name = 'payment.wipay.session'
+    _description = "Prefetched WiPay Hosted-Payment Session"
+    _order = 'id desc'
+    _log_access = False
+
+    provider_id = fields.Many2one(
+        string="Provider", comodel_name='payment.provider', required=True, ondelete='cascade'
+    )
+    reference = fields.Char(string="Reference", required=True, readonly=True, index=True)
+    total = fields.Char(
+        string="Total", help="The amount of the session, as sent to WiPay", required=True
+    )
+    currency = fields.Char(string="Currency", required=True)
+    payment_url = fields.Char(string="Payment URL", required=True)
+    wipay_payment_id = fields.Char(string="WiPay Payment ID")
+    expiry_date = fields.Datetime(
+        string="Expires On",
+        required=True,
+        default=lambda self: fields.Datetime.now() + relativedelta(
+            minutes=const.PREFETCHED_SESSION_TTL
+        ),
+    )
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _find(self, provider, reference, total, currency):
+        """ Return the unexpired session prefetched for the given reference and amount, if any.
+
+        The amount and currency are part of the lookup so that a session is never reused after
+        the order was modified.
+
+        :param recordset provider: The WiPay provider, as a `payment.provider` record.
+        :param str reference: The reference of the transaction.
+        :param str total: The amount of the transaction, as sent to WiPay.
+        :param str currency: The currency of the transaction, as sent to WiPay.
+        :return: The matching session, if any.
+        :rtype: recordset of `payment.wipay.session`
+        """
+        return self.search([
+            ('reference', '=', reference),
+            ('provider_id', '=', provider.id),
+            ('total', '=', total),
+            ('currency', '=', currency),
+            ('expiry_date', '>', fields.Datetime.now()),
+        ], limit=1)
+
+    @api.autovacuum
+    def _gc_expired_sessions(self):
+        self.sudo().search([('expiry_date', '<=', fields.Datetime.now())]).unlink()
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import logging
+import os
+import re
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+from odoo.tools import config, float_compare, split_every
+
+from odoo.addons.payment_wipay import const, utils
+
+_logger = logging.getLogger(__name__)
+
+# The size of the chunks read from JSON reports, in characters.
+JSON_CHUNK_SIZE = 1 << 16
+
+
+def _normalize_column(name):
+    return re.sub(r'\W+', '_', (name or '').strip().lower()).strip('_')
+
+
+def _iter_csv_rows(stream):
+    """ Yield the rows of a CSV settlement report one by one. """
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if not header:
+        return
+    keys = [const.SETTLEMENT_COLUMNS.get(_normalize_column(column)) for column in header]
+    for values in reader:
+        yield {key: value for key, value in zip(keys, values) if key}
+
+
+def _iter_json_rows(stream):
+    """ Yield the rows of a JSON settlement report one by one.
+
+    Both a top-level array of objects and JSON Lines are supported. The report is decoded one
+    chunk at a time so that only the objects being decoded are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        # Skip the separators between the objects.
+        while position < len(buffer) and buffer[position] in ' \t\r\n[],':
+            position += 1
+        if position == len(buffer) or buffer[position] == '{':
+            try:
+                row, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    if buffer[position:].strip():
+                        raise
+                    return
+                chunk = stream.read(JSON_CHUNK_SIZE)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            position = end
+            yield {
+                const.SETTLEMENT_COLUMNS[key]: value
+                for key, value in ((_normalize_column(k), v) for k, v in row.items())
+                if key in const.SETTLEMENT_COLUMNS
+            }
+        else:
+            raise ValueError(f"Unexpected character {buffer[position]!r} in the settlement report.")
+
+
+def _parse_amount(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(str(value).replace(',', '').strip())
+
+
+class PaymentWipaySettlementDiscrepancy(models.Model):
+    _name = 'payment.wipay.settlement.discrepancy'
+    _description = "WiPay Settlement Discrepancy"
+    _order = 'id desc'
+    _log_access = False
+
+    report_name = fields.Char(string="Settlement Report", required=True, readonly=True, index=True)
+    provider_id = fields.Many2one(
+        string="Provider", comodel_name='payment.provider', required=True, readonly=True,
+        ondelete='cascade',
+    )
+    kind = fields.Selection(
+        string="Discrepancy",
+        selection=[
+            ('amount', "Amount Mismatch"),
+            ('fee', "Fee Mismatch"),
+            ('missing', "Unknown Transaction"),
+            ('unsettled', "Not Settled"),
+        ],
+        help="Amount Mismatch: the settled amount differs from the amount of the transaction.\n"
+             "Fee Mismatch: the fee does not match the gross and net settled amounts.\n"
+             "Unknown Transaction: the settled transaction is not known to Odoo.\n"
+             "Not Settled: the confirmed transaction is missing from the report.",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    transaction_id = fields.Many2one(
+        string="Transaction", comodel_name='payment.transaction', readonly=True,
+        ondelete='cascade',
+    )
+    wipay_payment_id = fields.Char(string="WiPay Transaction ID", readonly=True)
+    reference = fields.Char(string="Reference", readonly=True)
+    expected_amount = fields.Float(string="Expected Amount", readonly=True)
+    settled_amount = fields.Float(string="Settled Amount", readonly=True)
+    fee = fields.Float(string="Fee", readonly=True)
+    net_amount = fields.Float(string="Net Amount", readonly=True)
+    import_date = fields.Datetime(
+        string="Imported On", readonly=True, default=fields.Datetime.now
+    )
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _import_settlement(
+        self, provider, stream, file_format, report_name, date_from=None, date_to=None,
+        chunk_size=1000,
+    ):
+        """ Match a WiPay settlement report against the transactions and record the discrepancies.
+
+        The report is streamed row by row and matched against an in-memory index of the WiPay
+        transactions, keyed by WiPay transaction id and by reference, that is built with a single
+        query. The discrepancies are created in chunks so that the memory used does not depend on
+        the size of the report.
+
+        If the settlement period is given, the index is restricted to the transactions created
+        around it, and the confirmed transactions of the period that are missing from the report
+        are flagged as not settled.
+
+        :param recordset provider: The WiPay provider, as a `payment.provider` record.
+        :param stream: The report, as a text file object.
+        :param str file_format: The format of the report, `csv` or `json`.
+        :param str report_name: The name of the report, saved on the discrepancies.
+        :param date date_from: The first day of the settlement period.
+        :param date date_to: The last day of the settlement period.
+        :param int chunk_size: The number of discrepancies created at once.
+        :return: The number of rows read and of discrepancies of each kind.
+        :rtype: dict
+        """
+        provider.ensure_one()
+        iter_rows = _iter_json_rows if file_format == 'json' else _iter_csv_rows
+        by_payment_id, by_reference = self._build_transaction_index(provider, date_from, date_to)
+        summary = {'rows': 0, 'matched': 0, 'amount': 0, 'fee': 0, 'missing': 0, 'unsettled': 0}
+        matched_ids = set()
+        pending = []
+        wipay_currency = self.env['res.currency'].browse(
+            provider._wipay_get_currency_id(provider.wipay_currency)
+        )
+        currency_precision = wipay_currency.decimal_places or 2
+
+        def _flag(kind, **values):
+            summary[kind] += 1
+            pending.append(dict(
+                values, kind=kind, report_name=report_name, provider_id=provider.id
+            ))
+            if len(pending) >= chunk_size:
+                self.create(pending)
+                pending.clear()
+
+        with utils.Timer() as timer:
+            for row in iter_rows(stream):
+                summary['rows'] += 1
+                payment_id = str(row.get('transaction_id') or '')
+                reference = str(row.get('reference') or '')
+                tx = by_payment_id.get(payment_id) or by_reference.get(reference)
+                amount = _parse_amount(row.get('amount'))
+                fee = _parse_amount(row.get('fee'))
+                net = _parse_amount(row.get('net'))
+                values = {
+                    'wipay_payment_id': payment_id,
+                    'reference': reference,
+                    'settled_amount': amount or 0.0,
+                    'fee': fee or 0.0,
+                    'net_amount': net or 0.0,
+                }
+                if not tx:
+                    _flag('missing', **values)
+                    continue
+
+                tx_id, tx_amount, currency_id, charged_amount, tx_date = tx
+                matched_ids.add(tx_id)
+                summary['matched'] += 1
+                values['transaction_id'] = tx_id
+                if amount is not None:
+                    expected_amount = charged_amount or self._convert_at_checkout(
+                        provider, tx_amount, currency_id, wipay_currency, tx_date
+                    )
+                    if float_compare(expected_amount, amount, precision_digits=currency_precision):
+                        _flag('amount', expected_amount=expected_amount, **values)
+                if None not in (amount, fee, net) and float_compare(
+                    amount - fee, net, precision_digits=currency_precision
+                ):
+                    _flag('fee', expected_amount=amount - fee, **values)
+
+            if date_from and date_to:
+                for tx_ids in split_every(chunk_size, self._get_confirmed_transaction_ids(
+                    provider, date_from, date_to
+                ) - matched_ids):
+                    for tx in self.env['payment.transaction'].browse(tx_ids):
+                        _flag(
+                            'unsettled',
+                            transaction_id=tx.id,
+                            wipay_payment_id=tx.wipay_payment_id,
+                            reference=tx.reference,
+                            expected_amount=tx.wipay_amount or tx.amount,
+                        )
+            if pending:
+                self.create(pending)
+
+        _logger.info(
+            "imported WiPay settlement report %s in %.2fs: %s", report_name, timer.duration, summary
+        )
+        return summary
+
+    @api.model
+    def _build_transaction_index(self, provider, date_from=None, date_to=None):
+        """ Return the WiPay transactions of the provider indexed by WiPay id and by reference.
+
+        Payments are settled a few days after they are made, so the index covers the
+        transactions created up to a month before the settlement period.
+
+        :return: The (id, amount, currency_id, wipay_amount, checkout date) tuple of each
+                 transaction, by WiPay transaction id and by reference.
+        :rtype: tuple
+        """
+        query = """
+            SELECT id, reference, wipay_payment_id, amount, currency_id, wipay_amount,
+                   create_date::date
+              FROM payment_transaction
+             WHERE provider_id = %s
+               AND operation != 'refund'
+        """
+        params = [provider.id]
+        if date_from:
+            query += " AND create_date >= %s"
+            params.append(date_from - relativedelta(months=1))
+        if date_to:
+            query += " AND create_date < %s"
+            params.append(date_to + relativedelta(days=1))
+        self.env.cr.execute(query, params)
+
+        by_payment_id, by_reference = {}, {}
+        for tx_id, reference, payment_id, amount, currency_id, charged_amount, tx_date in (
+            self.env.cr.fetchall()
+        ):
+            entry = (tx_id, amount, currency_id, charged_amount, tx_date)
+            by_reference[reference] = entry
+            if payment_id:
+                by_payment_id[payment_id] = entry
+        return by_payment_id, by_reference
+
+    @api.model
+    def _convert_at_checkout(self, provider, amount, currency_id, wipay_currency, tx_date):
+        """ Convert the amount of a transaction that predates the saving of the charged total into
+        the WiPay currency, at the conversion rate of its checkout date.
+
+        The conversion rate is cached in the registry, so that a report of many payments of a same
+        day only reads it once.
+        """
+        if currency_id == wipay_currency.id:
+            return amount
+        rate = provider._wipay_get_conversion_rate(
+            currency_id, wipay_currency.id, provider.company_id.id, tx_date
+        )
+        return wipay_currency.round(amount * rate)
+
+    @api.model
+    def _get_confirmed_transaction_ids(self, provider, date_from, date_to):
+        """ Return the ids of the transactions of the provider confirmed during the period. """
+        self.env.cr.execute("""
+            SELECT id
+              FROM payment_transaction
+             WHERE provider_id = %s
+               AND operation != 'refund'
+               AND state = 'done'
+               AND last_state_change >= %s
+               AND last_state_change < %s
+        """, [provider.id, date_from, date_to + relativedelta(days=1)])
+        return {tx_id for tx_id, in self.env.cr.fetchall()}
+
+    @api.model
+    def _cron_import_settlements(self):
+        """ Import the settlement reports dropped in the settlement directory.
+
+        The directory is set with the `wipay_settlement_dir` option of the Odoo configuration file.
+        Reports are imported for the WiPay provider of the main company, and moved to the `done`
+        subdirectory once imported so that they are imported only once. A report that cannot be
+        imported is moved to the `failed` subdirectory without blocking the next ones.
+
+        :return: None
+        """
+        directory = config.get('wipay_settlement_dir')
+        if not directory or not os.path.isdir(directory):
+            return
+        provider = self.env['payment.provider'].sudo().search(
+            [('code', '=', 'wipay'), ('company_id', '=', self.env.company.id)], limit=1
+        )
+        if not provider:
+            return
+
+        done_directory = os.path.join(directory, 'done')
+        failed_directory = os.path.join(directory, 'failed')
+        os.makedirs(done_directory, exist_ok=True)
+        os.makedirs(failed_directory, exist_ok=True)
+        for filename in sorted(os.listdir(directory)):
+            file_format = os.path.splitext(filename)[1].lower().lstrip('.')
+            if file_format not in ('csv', 'json', 'jsonl'):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, encoding='utf-8-sig', newline='') as stream:
+                    self._import_settlement(
+                        provider, stream, 'csv' if file_format == 'csv' else 'json', filename
+                    )
+            except Exception:  # noqa: BLE001 - a bad report must not block the next ones.
+                self.env.cr.rollback()
+                _logger.exception("unable to import WiPay settlement report %s", filename)
+                os.replace(path, os.path.join(failed_directory, filename))
+                continue
+            os.replace(path, os.path.join(done_directory, filename))
+            self.env.cr.commit()
+
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from odoo import api, fields, models
+
+
+class PaymentWipayStats(models.Model):
+    _name = 'payment.wipay.stats'
+    _description = "WiPay Job Statistics"
+    _log_access = False
+
+    name = fields.Char(string="Job", required=True, readonly=True)
+    counters = fields.Json(string="Counters", readonly=True)
+    last_run = fields.Json(string="Last Run", readonly=True)
+    updated_at = fields.Datetime(string="Updated On", readonly=True)
+
+    _sql_constraints = [
+        ('name_uniq', 'unique(name)', "There can only be one statistics record per job."),
+    ]
+
+    # === BUSINESS METHODS === #
+
+    @api.model
+    def _record(self, name, counters, last_run):
+        """ Add the counters of a run of a job to its totals and save the values of the run.
+
+        The statistics are saved in the database, rather than in the worker that runs the job, so
+        that they can be exposed by any worker. They are updated with a single upsert in the
+        current transaction.
+
+        :param str name: The name of the job, e.g., `queue`.
+        :param dict counters: The increments of the cumulative counters of the job.
+        :param dict last_run: The values of the run, replacing those of the previous run.
+        :return: None
+        """
+        self.env.cr.execute("""
+            INSERT INTO payment_wipay_stats AS stats (name, counters, last_run, updated_at)
+            VALUES (%(name)s, %(counters)s, %(last_run)s, NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (name) DO UPDATE
+               SET counters = (
+                       SELECT jsonb_object_agg(
+                                  increment.key,
+                                  COALESCE((stats.counters->>increment.key)::numeric, 0)
+                                  + increment.value::numeric
+                              )
+                         FROM jsonb_each_text(EXCLUDED.counters) AS increment
+                   ),
+                   last_run = EXCLUDED.last_run,
+                   updated_at = EXCLUDED.updated_at
+        """, {'name': name, 'counters': json.dumps(counters), 'last_run': json.dumps(last_run)})
+
+    @api.model
+    def _get(self, name, defaults):
+        """ Return the cumulative counters and the values of the last run of a job.
+
+        :param str name: The name of the job.
+        :param dict defaults: The values to return for the job's statistics that were never
+                              recorded.
+        :return: The statistics of the job.
+        :rtype: dict
+        """
+        self.env.cr.execute(
+            "SELECT counters, last_run FROM payment_wipay_stats WHERE name = %s", [name]
+        )
+        stats = dict(defaults)
+        for counters, last_run in self.env.cr.fetchall():
+            stats.update(counters or {}, **(last_run or {}))
+        return stats
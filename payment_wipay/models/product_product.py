@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+from odoo.addons.payment_wipay import const
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if any(vals.get('type') == 'service' for vals in vals_list):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay payment product.
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if const.PRODUCT_METADATA_FIELDS & vals.keys() and (
+            vals.get('type') == 'service' or any(product.type == 'service' for product in self)
+        ):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay payment product.
+        return super().write(vals)
+
+    def unlink(self):
+        if any(product.type == 'service' for product in self):
+            self.env.registry.clear_cache()  # Invalidate the cached WiPay payment product.
+        return super().unlink()
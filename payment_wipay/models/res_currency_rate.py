@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+
+class ResCurrencyRate(models.Model):
+    _inherit = 'res.currency.rate'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env.registry.clear_cache()  # Invalidate the cached WiPay conversion rates.
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env.registry.clear_cache()  # Invalidate the cached WiPay conversion rates.
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()  # Invalidate the cached WiPay conversion rates.
+        return super().unlink()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+""" Signing and verification of the WiPay signatures with precomputed key material.
+
+WiPay signatures are the hex digest of a key followed by fields of the payment. The key is fed to
+the hash once per signer; signing a payment then only copies the keyed state and hashes the fields.
+"""
+
+import functools
+import hashlib
+import hmac
+
+# The supported signature schemes; `md5` and `sha256` hash the key followed by the fields.
+SCHEMES = ('md5', 'sha256', 'hmac_sha256')
+
+
+class Signer:
+    """ Signer of the WiPay signatures of a key with a scheme. Signers are safe to share. """
+
+    __slots__ = ('_keyed',)
+
+    def __init__(self, scheme, key):
+        key = (key or '').encode('utf-8')
+        if scheme == 'hmac_sha256':
+            self._keyed = hmac.new(key, digestmod=hashlib.sha256)
+        elif scheme in SCHEMES:
+            self._keyed = hashlib.new(scheme, key)
+        else:
+            raise ValueError(f"Unsupported WiPay signature scheme: {scheme}")
+
+    def sign(self, *fields):
+        """ Return the signature of the fields, concatenated in the given order. """
+        digest = self._keyed.copy()
+        digest.update(''.join(map(str, fields)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def verify(self, signature, *fields):
+        """ Return whether the signature matches the fields, in constant time. """
+        return hmac.compare_digest(
+            self.sign(*fields).encode('utf-8'), str(signature or '').encode('utf-8')
+        )
+
+
+@functools.lru_cache(maxsize=128)
+def get_signer(scheme, key):
+    """ Return the signer of a key with a scheme, creating it if needed. """
+    return Signer(scheme, key)
@@ -1,28 +1,22 @@
 // payment_wipay/static/src/js/payment_form.js
 /** @odoo-module **/
 
+import { rpc } from '@web/core/network/rpc';
 import PaymentForm from '@payment/js/payment_form';
 
 PaymentForm.include({
     /**
-     * Override token flow if WiPay needs redirect-based handling.
+     * Prefetch the WiPay hosted-payment session of the cart as soon as WiPay is selected, so that
+     * the redirection does not wait for WiPay once the customer confirms the payment.
      */
-    _processTokenFlow(providerCode, paymentOptionId, paymentMethodCode, processingValues) {
-        if (providerCode === 'wipay') {
-            // Optional: log or debug
-            console.log('Redirecting via WiPay with:', processingValues);
-
-            // Example: open payment URL
-            if (processingValues && processingValues.payment_url) {
-                window.open(processingValues.payment_url, '_blank');
-            } else {
-                console.warn('WiPay payment_url missing in processingValues.');
-            }
-
-            return;
+    async _prepareInlineForm(providerId, providerCode, paymentOptionId, paymentMethodCode, flow) {
+        if (
+            providerCode === 'wipay'
+            && flow !== 'token'
+            && (this.paymentContext.transactionRoute || '').startsWith('/shop/')
+        ) {
+            rpc('/payment/wipay/prefetch', { provider_id: providerId }).catch(() => {});
         }
-
-        // fallback to default
-        this._super(...arguments);
+        return this._super(...arguments);
     },
 });
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+from . import test_checkout
+from . import test_pay_route
+from . import test_performance
+from . import test_settlement_parsing
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from odoo.addons.payment.tests.common import PaymentCommon
+
+
+class WipayCommon(PaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.wipay = cls._prepare_provider('wipay', update_values={
+            'wipay_merchant_account_id': '1234567890',
+            'wipay_api_key': '123',
+            'wipay_secret_key': '123',
+            'wipay_api_url': 'https://tt.wipayfinancial.com/plugins/payments/request',
+            'wipay_currency': 'USD',
+            'wipay_webhook_queue': False,
+        })
+        cls.provider = cls.wipay
+        cls.currency = cls.currency_usd
+        cls.payment_method_id = cls.env.ref('payment_wipay.payment_method_wipay').id
+        cls.partner.country_id = cls.env.ref('base.tt')
+
+        cls.session_data = {
+            'url': 'https://tt.wipayfinancial.com/plugins/payments/hosted?id=WPY-0001',
+            'transaction_id': 'WPY-0001',
+        }
+        cls.notification_data = {
+            'order_id': cls.reference,
+            'transaction_id': 'WPY-0001',
+            'status': 'success',
+            'total': f'{cls.amount:.2f}',
+        }
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_wipay.models.payment_provider import PaymentProvider
+from odoo.addons.payment_wipay.tests.common import WipayCommon
+
+
+@tagged('post_install', '-at_install')
+class TestCheckout(WipayCommon):
+
+    def test_checkout_does_not_write_the_provider(self):
+        """ Test that the checkout never writes on the provider, whose row is shared by all the
+        checkouts: a write would make concurrent checkouts wait on its row lock. """
+        txs = self.env['payment.transaction'].union(*(
+            self._create_transaction('redirect', reference=f'{self.reference}-{index}')
+            for index in range(3)
+        ))
+
+        with patch.object(
+            PaymentProvider, '_wipay_make_request', return_value=self.session_data
+        ), patch.object(
+            PaymentProvider, 'write', autospec=True, side_effect=PaymentProvider.write
+        ) as write_mock:
+            processing_values = [tx._get_processing_values() for tx in txs]
+
+        self.assertFalse(write_mock.called, "The checkout must not write on the provider.")
+        self.assertEqual(
+            [values['reference'] for values in processing_values], txs.mapped('reference'),
+            "Each checkout must render the values of its own transaction.",
+        )
+        self.assertTrue(all(values['redirect_form_html'] for values in processing_values))
+        self.assertEqual(set(txs.mapped('wipay_payment_id')), {'WPY-0001'})
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from odoo.exceptions import ValidationError
+from odoo.tests import tagged
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_wipay.tests.common import WipayCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPayRoute(WipayCommon):
+
+    def _create_pay_transaction(self, access_token=None, **kwargs):
+        if access_token is None:
+            access_token = payment_utils.generate_access_token(
+                self.partner.id, self.amount, self.currency.id
+            )
+        return self.env['payment.transaction'].sudo()._wipay_create_pay_transaction(
+            self.provider.id, self.amount, self.currency.id, self.partner.id, access_token, **kwargs
+        )
+
+    def test_pay_transaction_is_created_for_valid_request(self):
+        tx = self._create_pay_transaction(prefix='TEST')
+        self.assertEqual(tx.provider_id, self.provider)
+        self.assertEqual(tx.payment_method_id.id, self.payment_method_id)
+        self.assertEqual(tx.operation, 'online_redirect')
+        self.assertTrue(tx.reference.startswith('TEST-'))
+
+    def test_pay_transaction_prefix_is_sanitized(self):
+        tx = self._create_pay_transaction(prefix="Çafé <script> " + "x" * 100)
+        prefix = tx.reference.rsplit('-', 1)[0]
+        self.assertTrue(prefix.startswith('Cafescript'))
+        self.assertLessEqual(len(prefix), 32)
+        tx = self._create_pay_transaction(prefix="<>")
+        self.assertTrue(tx.reference.startswith('WIPAY-'))
+
+    def test_pay_transaction_requires_valid_access_token(self):
+        with self.assertRaises(ValidationError):
+            self._create_pay_transaction(access_token='invalid')
+        other_amount_token = payment_utils.generate_access_token(
+            self.partner.id, self.amount + 1, self.currency.id
+        )
+        with self.assertRaises(ValidationError):
+            self._create_pay_transaction(access_token=other_amount_token)
+
+    def test_pay_transaction_rejects_unknown_invoice(self):
+        with self.assertRaises(ValidationError):
+            self._create_pay_transaction(invoice_id=-1)
+
+    def test_pay_transaction_query_budget(self):
+        """ Test that creating a transaction of the pay route stays within its query budget once
+        the WiPay metadata is cached. """
+        self._create_pay_transaction()  # Warm up the registry cache.
+        self.env.invalidate_all()
+        with self.assertQueryCount(20):
+            self._create_pay_transaction()
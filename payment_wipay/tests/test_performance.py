@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from urllib.parse import urlencode
+
+from odoo.tests import HttpCase, tagged
+
+from odoo.addons.payment_wipay.tests.common import WipayCommon
+from odoo.addons.payment_wipay.tools import bench
+from odoo.addons.payment_wipay.tools.fake_wipay import FakeWipayServer
+
+_logger = logging.getLogger(__name__)
+
+# The maximum average number of SQL queries per request of each path, including the HTTP dispatch
+# and the rate limiting of the route.
+QUERY_BUDGETS = {
+    'pay': 60,
+    'webhook': 50,
+    'return': 70,
+}
+
+REQUESTS = 10
+
+
+@tagged('post_install', '-at_install')
+class TestPerformance(WipayCommon, HttpCase):
+
+    def _send(self, path, setup, index):
+        url_path, kwargs = bench._build_request(path, setup, index)
+        if kwargs['method'] == 'GET':
+            url_path += '?' + urlencode(kwargs['params'])
+        return self.url_open(
+            url_path,
+            data=kwargs.get('data'),
+            headers=kwargs.get('headers'),
+            allow_redirects=kwargs.get('allow_redirects', True),
+        )
+
+    def test_hot_paths_stay_within_query_budget(self):
+        """ Test that the pay, webhook and return routes succeed against the fake WiPay API and
+        stay within their query budget. The requests are sent one at a time: in test mode, the
+        server serves them on the cursor of the test, so the latencies are only reported. """
+        for route in bench.PATHS:
+            self.env['ir.config_parameter'].set_param(
+                f'payment_wipay.rate_limit.{route}', bench.BENCH_RATE_LIMIT
+            )
+        with FakeWipayServer(latency=0.01) as server:
+            setup = bench._setup(self.env, server, bench.PATHS, requests=REQUESTS)
+            self.env.flush_all()
+            for path in bench.PATHS:
+                durations, queries = [], []
+                for index in range(REQUESTS):
+                    query_count = self.cr.sql_log_count
+                    start = time.perf_counter()
+                    response = self._send(path, setup, index)
+                    durations.append(time.perf_counter() - start)
+                    queries.append(self.cr.sql_log_count - query_count)
+                    self.assertIsNone(
+                        bench._get_response_error(path, response),
+                        f"A request of the {path} path failed.",
+                    )
+                durations.sort()
+                _logger.info(
+                    "%s: p50 %.1f ms, queries avg %.1f max %d", path,
+                    bench._percentile(durations, 0.5) * 1000, sum(queries) / REQUESTS, max(queries),
+                )
+                self.assertLessEqual(
+                    sum(queries) / REQUESTS, QUERY_BUDGETS[path],
+                    f"The {path} path exceeds its query budget.",
+                )
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+from unittest.mock import patch
+
+from odoo.tests import tagged
+from odoo.tests.common import BaseCase
+
+from odoo.addons.payment_wipay.models import payment_wipay_settlement
+from odoo.addons.payment_wipay.models.payment_wipay_settlement import _iter_json_rows
+
+
+@tagged('post_install', '-at_install')
+class TestSettlementParsing(BaseCase):
+
+    rows = [
+        {'Transaction ID': 'WP-1', 'Order ID': 'S00001', 'Total': '10.00', 'Fee': '0.50'},
+        {'Transaction ID': 'WP-2', 'Order ID': 'S00002 [], {}', 'Total': 20, 'Unknown': 'x'},
+        {'Transaction ID': 'WP-3', 'Order ID': 'S00003', 'Net Amount': '9.50'},
+    ]
+    expected_rows = [
+        {'transaction_id': 'WP-1', 'reference': 'S00001', 'amount': '10.00', 'fee': '0.50'},
+        {'transaction_id': 'WP-2', 'reference': 'S00002 [], {}', 'amount': 20},
+        {'transaction_id': 'WP-3', 'reference': 'S00003', 'net': '9.50'},
+    ]
+
+    def _parse(self, content, chunk_size=payment_wipay_settlement.JSON_CHUNK_SIZE):
+        with patch.object(payment_wipay_settlement, 'JSON_CHUNK_SIZE', chunk_size):
+            return list(_iter_json_rows(io.StringIO(content)))
+
+    def test_json_array_is_parsed(self):
+        self.assertEqual(self._parse(json.dumps(self.rows, indent=2)), self.expected_rows)
+
+    def test_json_lines_are_parsed(self):
+        content = '\n'.join(json.dumps(row) for row in self.rows) + '\n'
+        self.assertEqual(self._parse(content), self.expected_rows)
+
+    def test_rows_split_across_chunks_are_parsed(self):
+        array = json.dumps(self.rows)
+        lines = '\r\n'.join(json.dumps(row) for row in self.rows)
+        for chunk_size in (1, 2, 7, len(array) - 1):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self._parse(array, chunk_size), self.expected_rows)
+                self.assertEqual(self._parse(lines, chunk_size), self.expected_rows)
+
+    def test_empty_reports_have_no_rows(self):
+        for content in ('', '[]', ' \n[\n]\n'):
+            with self.subTest(content=content):
+                self.assertEqual(self._parse(content, chunk_size=1), [])
+
+    def test_malformed_reports_are_rejected(self):
+        for content in (
+            '[{"Transaction ID": "WP-1"}, {"Transaction ID": ',  # Truncated object.
+            '{"Transaction ID": "WP-1"}\n{"Transaction ID" "WP-2"}',  # Invalid object.
+            '["WP-1", "WP-2"]',  # Not objects.
+            'Transaction ID,Total\nWP-1,10.00\n',  # Not JSON.
+        ):
+            with self.subTest(content=content), self.assertRaises(ValueError):
+                self._parse(content, chunk_size=4)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+""" Load benchmark of the WiPay hot paths against a local fake WiPay API.
+
+The benchmark sends HTTP requests to the three public routes of a running Odoo server, at a
+configurable concurrency, so that the whole request is measured: dispatch, rate limiting,
+controller and commit.
+
+- `pay`: `/payment/wipay/pay`, i.e., `_wipay_create_pay_transaction` and `_get_processing_values`;
+- `webhook`: `/payment/wipay/webhook`, i.e., `_wipay_ingest_notification`;
+- `return`: `/payment/wipay/return`, i.e., `_handle_notification_data`.
+
+It reports the p50/p95/p99 latency, the throughput and the number of failed requests.
+
+Run it from an Odoo shell on a disposable database where payment_wipay is installed, while an
+Odoo server serves the same database, as it commits an unpublished benchmark provider and its
+transactions:
+
+    $ odoo-bin shell -d bench_db
+    >>> from odoo.addons.payment_wipay.tools import bench
+    >>> bench.run(env, 'http://localhost:8069', concurrency=8, requests=200, latency=0.05)
+
+The rate limits of the routes are raised for the duration of the run, as all the requests come
+from the same address. The query budget of each path is enforced by `tests/test_performance.py`,
+which sends the same requests on a test database.
+"""
+
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as requests_lib
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment_wipay import const
+from odoo.addons.payment_wipay.controllers.main import WipayController
+from odoo.addons.payment_wipay.tools.fake_wipay import FakeWipayServer
+
+_logger = logging.getLogger(__name__)
+
+PATHS = ('pay', 'webhook', 'return')
+
+# The rate limit of each route during the run, high enough never to be reached.
+BENCH_RATE_LIMIT = '1000000/1000000'
+
+
+def run(env, base_url, paths=PATHS, concurrency=8, requests=200, latency=0.0, error_rate=0.0):
+    """ Run the benchmark and print its report.
+
+    :param odoo.api.Environment env: The environment of the benchmarked database.
+    :param str base_url: The URL of the Odoo server serving the database.
+    :param tuple paths: The paths to benchmark, among `PATHS`.
+    :param int concurrency: The number of requests run in parallel.
+    :param int requests: The number of requests per path.
+    :param float latency: The latency of the fake WiPay API, in seconds.
+    :param float error_rate: The probability that the fake WiPay API answers with an error.
+    :return: The report of each path.
+    :rtype: dict
+    """
+    ICP = env['ir.config_parameter'].sudo()
+    rate_limits = {route: ICP.get_param(f'payment_wipay.rate_limit.{route}') for route in paths}
+    with FakeWipayServer(latency=latency, error_rate=error_rate) as server:
+        setup = _setup(env, server, paths, requests)
+        for route in paths:
+            ICP.set_param(f'payment_wipay.rate_limit.{route}', BENCH_RATE_LIMIT)
+        env.cr.commit()
+        try:
+            reports = {}
+            for path in paths:
+                reports[path] = _run_path(base_url, path, setup, concurrency, requests)
+                print(_format_report(path, reports[path]))  # noqa: T201
+        finally:
+            for route, value in rate_limits.items():
+                ICP.set_param(f'payment_wipay.rate_limit.{route}', value or False)
+            env.cr.commit()
+    return reports
+
+
+def _setup(env, server, paths, requests):
+    """ Create an unpublished WiPay provider pointing to the fake API and the transactions to
+    notify. The providers of the database are left untouched. """
+    provider = env.ref('payment_wipay.payment_provider_payway').copy({
+        'name': "WiPay Benchmark",
+        'state': 'test',
+        'is_published': False,
+        'wipay_api_url': server.url + const.API_ENDPOINTS['request'],
+        'wipay_region_routing': False,
+        'wipay_webhook_queue': False,
+    })
+    partner = env['res.partner'].create({
+        'name': "WiPay Benchmark",
+        'email': 'wipay.bench@example.com',
+        'country_id': env.ref('base.tt').id,
+    })
+    setup = {
+        'run_id': uuid.uuid4().hex[:12],
+        'provider_id': provider.id,
+        'partner_id': partner.id,
+        'currency_id': env.company.currency_id.id,
+    }
+    setup['access_token'] = payment_utils.generate_access_token(
+        partner.id, 100.0, setup['currency_id']
+    )
+    for path in set(paths) & {'webhook', 'return'}:
+        txs = env['payment.transaction'].create([{
+            'provider_id': provider.id,
+            'payment_method_id': provider.payment_method_ids[:1].id,
+            'reference': f'BENCH-{path}-{setup["run_id"]}-{index:06d}',
+            'amount': 100.0,
+            'currency_id': setup['currency_id'],
+            'partner_id': partner.id,
+        } for index in range(requests)])
+        setup[path] = txs.mapped('reference')
+    return setup
+
+
+def _build_request(path, setup, index):
+    """ Return the HTTP request of a path, as the URL path and the keyword arguments of
+    `requests.request`. """
+    if path == 'pay':
+        return WipayController._pay_route, {
+            'method': 'POST',
+            'data': json.dumps({
+                'jsonrpc': '2.0',
+                'method': 'call',
+                'id': index,
+                'params': {
+                    'provider_id': setup['provider_id'],
+                    'amount': 100.0,
+                    'currency_id': setup['currency_id'],
+                    'partner_id': setup['partner_id'],
+                    'access_token': setup['access_token'],
+                },
+            }),
+            'headers': {'Content-Type': 'application/json'},
+        }
+    data = {
+        'order_id': setup[path][index],
+        # Unique per path and per run, so that no notification is suppressed as the duplicate of
+        # another one by the ledger.
+        'transaction_id': f'BENCH-{path}-{setup["run_id"]}-{index:06d}',
+        'status': 'success',
+    }
+    if path == 'webhook':
+        return WipayController._webhook_url, {'method': 'POST', 'data': data}
+    return WipayController._return_url, {
+        'method': 'GET', 'params': data, 'allow_redirects': False,
+    }
+
+
+def _get_response_error(path, response):
+    """ Return why the response of a path is a failure, or None if it is a success. """
+    if path == 'return':
+        return None if response.status_code == 303 else f"HTTP {response.status_code}"
+    if response.status_code != 200:
+        return f"HTTP {response.status_code}"
+    if path == 'webhook':
+        return None if response.text == 'ok' else response.text
+    return (response.json().get('error') or {}).get('message')
+
+
+def _run_path(base_url, path, setup, concurrency, requests):
+    """ Send the requests of a path and return the report of their latencies. """
+    local = threading.local()
+
+    def _request(index):
+        if not hasattr(local, 'session'):
+            local.session = requests_lib.Session()
+        url_path, kwargs = _build_request(path, setup, index)
+        start = time.perf_counter()
+        try:
+            response = local.session.request(url=base_url.rstrip('/') + url_path, **kwargs)
+            error = _get_response_error(path, response)
+        except requests_lib.exceptions.RequestException as exc:
+            error = exc
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_request, range(requests)))
+    wall_time = time.perf_counter() - start
+
+    durations = sorted(duration for duration, _error in results)
+    errors = [error for _duration, error in results if error]
+    if errors:
+        _logger.warning("%s requests of the %s path failed, e.g.: %s", len(errors), path, errors[0])
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'throughput': requests / wall_time if wall_time else 0.0,
+        'p50': _percentile(durations, 0.50) * 1000,
+        'p95': _percentile(durations, 0.95) * 1000,
+        'p99': _percentile(durations, 0.99) * 1000,
+    }
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def _format_report(path, report):
+    return (
+        "%(path)-8s %(requests)5d req x%(concurrency)-3d %(throughput)8.1f req/s  "
+        "p50 %(p50)7.1f ms  p95 %(p95)7.1f ms  p99 %(p99)7.1f ms  errors %(errors)d"
+    ) % dict(report, path=path)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+""" A local stand-in for the WiPay payments API, for benchmarks and manual testing.
+
+Point the API URL of a WiPay provider at the server (e.g., http://127.0.0.1:8765/plugins/payments/
+request) to route the hosted-payment, status and refund requests to it:
+
+    with FakeWipayServer(latency=0.05, error_rate=0.01) as server:
+        provider.wipay_api_url = server.url + '/plugins/payments/request'
+        ...
+
+It can also be run standalone: python -m odoo.addons.payment_wipay.tools.fake_wipay --port 8765
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from odoo.addons.payment_wipay import const
+
+
+class FakeWipayServer:
+    """ Threaded HTTP server answering like the WiPay payments API.
+
+    :param float latency: The delay, in seconds, added before each response.
+    :param float jitter: The maximum random delay, in seconds, added to the latency.
+    :param float error_rate: The probability that a request is answered with a 503 error.
+    :param str status: The status returned by the status and refund endpoints.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 status='success'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.status = status
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _answer(self, path, params):
+        """ Return the status code and the JSON content of the response to a request. """
+        with self._lock:
+            self.request_count += 1
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            return 503, {'message': "Service temporarily unavailable"}
+
+        transaction_id = params.get('transaction_id') or uuid.uuid4().hex[:16].upper()
+        if path == const.API_ENDPOINTS['request']:
+            return 200, {
+                'url': f'{self.url}/checkout/{transaction_id}',
+                'transaction_id': transaction_id,
+                'message': "OK",
+            }
+        if path in (const.API_ENDPOINTS['status'], const.API_ENDPOINTS['refund']):
+            return 200, {
+                'status': self.status,
+                'transaction_id': transaction_id,
+                'order_id': params.get('order_id'),
+            }
+        if path == '/':
+            return 200, {'status': 'ok'}
+        return 404, {'message': "Not found"}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _reply(self, params):
+                status, content = server._answer(urlparse(self.path).path, params)
+                body = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self._reply(dict(parse_qsl(urlparse(self.path).query)))
+
+            def do_HEAD(self):
+                self._reply({})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self._reply(dict(parse_qsl(self.rfile.read(length).decode())))
+
+            def log_message(self, *args):
+                pass  # Keep the benchmark output readable.
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake WiPay payments API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--status', default='success')
+    args = parser.parse_args()
+    server = FakeWipayServer(
+        args.host, args.port, args.latency, args.jitter, args.error_rate, args.status
+    )
+    print(f"Fake WiPay API listening on {server.url}")  # noqa: T201
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+
+from odoo import sql_db
+from odoo.tools import config
+
+from odoo.addons.payment_wipay import metrics
+
+_logger = logging.getLogger(__name__)
+
+# Pooled HTTP sessions, one per (database, provider) and per worker process.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Round-trip timings of the most recent WiPay calls, per (database, provider).
+_latencies = {}
+LATENCY_SAMPLES = 500
+
+POOL_SIZE = 10
+RETRY_STATUSES = (502, 503, 504)
+
+# The default maximum number of calls to WiPay in flight per database, across all the workers,
+# overridden by the `wipay_max_inflight_requests` option of the Odoo configuration file, the number
+# of seconds a call waits for a slot before failing and the delay between two attempts. The slots
+# are PostgreSQL advisory locks in the `INFLIGHT_LOCK_SPACE` key space.
+MAX_INFLIGHT_REQUESTS = 16
+INFLIGHT_WAIT = 2.0
+INFLIGHT_POLL_INTERVAL = 0.05
+INFLIGHT_LOCK_SPACE = 0x57495059  # "WIPY"
+
+
+def get_session(key, max_retries):
+    """ Return the pooled session for the given key, creating it if needed.
+
+    Connection errors are retried for every method since the request never reached WiPay. Read
+    errors and 5xx statuses are only retried for idempotent methods so that a hosted-payment request
+    is never submitted twice.
+
+    :param tuple key: The (database name, provider id) the session belongs to.
+    :param int max_retries: The retry budget of the session.
+    :return: The pooled session.
+    :rtype: requests.Session
+    """
+    entry = _sessions.get(key)
+    if entry and entry[0] == max_retries:
+        return entry[1]
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        if entry and entry[0] == max_retries:
+            return entry[1]
+        if entry:
+            entry[1].close()
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            status_forcelist=RETRY_STATUSES,
+            backoff_factor=0.2,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[key] = (max_retries, session)
+        return session
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised instead of calling a WiPay host whose circuit breaker is open. """
+
+
+class InflightLimitError(requests.exceptions.ConnectionError):
+    """ Raised instead of calling WiPay when too many calls are in flight across the workers. """
+
+
+@contextmanager
+def inflight_slot(dbname):
+    """ Hold one of the slots of calls to WiPay in flight shared by all workers of a database.
+
+    A slot is a transaction-level advisory lock taken on a dedicated connection; it is released when
+    the connection's transaction ends, including when the worker holding it dies. If the database
+    cannot be reached, the call is let through.
+
+    :param str dbname: The database the call is made for.
+    :return: None
+    :raise InflightLimitError: If no slot is freed within `INFLIGHT_WAIT` seconds.
+    """
+    try:
+        cr = sql_db.db_connect(dbname).cursor()
+    except (psycopg2.Error, sql_db.PoolError):
+        _logger.warning("unable to cap the WiPay calls in flight", exc_info=True)
+        cr = None
+    try:
+        if cr is not None:
+            limit = int(config.get('wipay_max_inflight_requests') or MAX_INFLIGHT_REQUESTS)
+            deadline = time.monotonic() + INFLIGHT_WAIT
+            while True:
+                cr.execute("""
+                    SELECT slot
+                      FROM generate_series(0, %s) AS slot
+                     WHERE pg_try_advisory_xact_lock(%s, slot)
+                     LIMIT 1
+                """, [limit - 1, INFLIGHT_LOCK_SPACE])
+                if cr.fetchone():
+                    break
+                if time.monotonic() >= deadline:
+                    raise InflightLimitError("Too many calls to WiPay are in flight")
+                time.sleep(INFLIGHT_POLL_INTERVAL)
+        yield
+    finally:
+        if cr is not None:
+            cr.close()  # Rolls the transaction back, which releases the slot.
+
+
+class CircuitBreaker:
+    """ Per-worker circuit breaker of a WiPay host.
+
+    After `failure_threshold` consecutive failures, the circuit opens and calls fail immediately for
+    `reset_timeout` seconds. A single trial call is then let through: the circuit closes if it
+    succeeds and opens again otherwise.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_pending = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial_pending or time.monotonic() < self.opened_at + self.reset_timeout:
+                return False
+            self._trial_pending = True
+            return True
+
+    def record(self, success):
+        with self._lock:
+            self._trial_pending = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+
+
+_breakers = {}
+
+
+def get_breaker(host):
+    """ Return the circuit breaker of a WiPay host, creating it if needed. """
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _sessions_lock:
+            breaker = _breakers.setdefault(host, CircuitBreaker())
+    return breaker
+
+
+# Everything needed to call WiPay without touching the ORM, e.g., from a worker thread.
+RequestSpec = namedtuple('RequestSpec', ['key', 'session', 'headers', 'timeout'])
+
+
+def send_request(spec, url, payload=None, method='POST'):
+    """ Send a request to WiPay through the pooled session of the spec and record its timing.
+
+    This function does not access the ORM and is thus safe to call from any thread. The number of
+    calls in flight is capped across the workers of the database, whose name is the first item of
+    the key of the spec, to protect the workers from a slow WiPay API.
+
+    :param RequestSpec spec: The session, headers and timeouts to use.
+    :param str url: The URL to call.
+    :param dict payload: The payload of the request.
+    :param str method: The HTTP method of the request.
+    :return: The JSON-formatted content of the response.
+    :rtype: dict
+    :raise requests.exceptions.RequestException: If an HTTP error occurs, if the circuit breaker of
+                                                 the host is open or if too many calls are in
+                                                 flight.
+    :raise ValueError: If the response is not valid JSON.
+    """
+    try:
+        with inflight_slot(spec.key[0]):
+            return _send_request(spec, url, payload=payload, method=method)
+    except InflightLimitError:
+        metrics.inc('wipay_api_requests_total', endpoint=urlparse(url).path, outcome='throttled')
+        raise
+
+
+def send_probe(spec, url):
+    """ Send a health probe to a WiPay host and return its round-trip duration.
+
+    The probe goes through the cap of calls in flight and the request metrics like `send_request`,
+    but not through the circuit breaker of the host: breakers are per worker process, and the
+    probes run in the cron worker only. Any response below 500 counts as healthy.
+
+    :param RequestSpec spec: The session, headers and timeouts to use.
+    :param str url: The URL to probe.
+    :return: The duration of the probe, in seconds.
+    :rtype: float
+    :raise requests.exceptions.RequestException: If the probe fails or too many calls are in
+                                                 flight.
+    """
+    endpoint = urlparse(url).path or '/'
+    outcome = 'error'
+    timer = Timer()
+    try:
+        with inflight_slot(spec.key[0]):
+            with timer:
+                response = spec.session.head(url, headers=spec.headers, timeout=spec.timeout)
+        if response.status_code >= 500:
+            raise requests.exceptions.HTTPError(
+                f"{response.status_code} {response.reason}", response=response
+            )
+        outcome = 'ok'
+        return timer.duration
+    except InflightLimitError:
+        outcome = 'throttled'
+        raise
+    finally:
+        metrics.observe('wipay_api_request_duration_seconds', timer.duration, endpoint=endpoint)
+        metrics.inc('wipay_api_requests_total', endpoint=endpoint, outcome=outcome)
+
+
+def _send_request(spec, url, payload, method):
+    parsed_url = urlparse(url)
+    endpoint = parsed_url.path
+    breaker = get_breaker(parsed_url.netloc)
+    if not breaker.allow():
+        metrics.inc('wipay_api_requests_total', endpoint=endpoint, outcome='circuit_open')
+        raise CircuitOpenError(f"The circuit breaker of {parsed_url.netloc} is open")
+
+    outcome = 'error'
+    response = None
+    timer = Timer(spec.key)
+    try:
+        with timer:
+            if method == 'GET':
+                response = spec.session.get(
+                    url, params=payload, headers=spec.headers, timeout=spec.timeout
+                )
+            else:
+                response = spec.session.request(
+                    method, url, data=payload, headers=spec.headers, timeout=spec.timeout
+                )
+        breaker.record(response.status_code < 500)
+        response.raise_for_status()
+        response_data = response.json()
+        outcome = 'ok'
+        return response_data
+    finally:
+        # Any error before a response (SSL, redirects, invalid URL...) counts as a failure, so
+        # that the trial request of a half-open breaker never stays pending.
+        if response is None:
+            breaker.record(False)
+        metrics.observe('wipay_api_request_duration_seconds', timer.duration, endpoint=endpoint)
+        metrics.inc('wipay_api_requests_total', endpoint=endpoint, outcome=outcome)
+
+
+def is_unsent_error(error):
+    """ Return whether the request that raised the error provably never reached WiPay.
+
+    This is the case if the circuit breaker or the in-flight cap rejected the call, or if the
+    connection could not be established. Read timeouts, dropped connections and error statuses are
+    ambiguous: WiPay may have processed the request anyway.
+
+    :param Exception error: The error raised by `send_request`.
+    :return: Whether the request was never sent.
+    :rtype: bool
+    """
+    if isinstance(error, (CircuitOpenError, InflightLimitError, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def send_request_with_retries(spec, url, payload=None, method='POST', attempts=3, backoff=0.5):
+    """ Send a request to WiPay and retry it if it never reached WiPay.
+
+    Only the connection errors of `is_unsent_error` are retried, so that a request that is not
+    idempotent on WiPay's side, such as a refund, is never submitted twice. The circuit breaker and
+    the in-flight cap are not waited for.
+
+    :param int attempts: The maximum number of attempts.
+    :param float backoff: The delay before the first retry, doubled after each attempt.
+    :return: The JSON-formatted content of the response.
+    :rtype: dict
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return send_request(spec, url, payload=payload, method=method)
+        except (CircuitOpenError, InflightLimitError):
+            raise
+        except requests.exceptions.ConnectionError as error:
+            if attempt == attempts or not is_unsent_error(error):
+                raise
+        time.sleep(backoff * 2 ** (attempt - 1))
+
+
+# Per-host semaphores bounding the number of concurrent calls made by worker threads.
+_host_semaphores = {}
+
+
+def _get_host_semaphore(host, limit):
+    with _sessions_lock:
+        semaphore = _host_semaphores.get((host, limit))
+        if semaphore is None:
+            semaphore = _host_semaphores[(host, limit)] = threading.BoundedSemaphore(limit)
+        return semaphore
+
+
+def map_concurrently(calls, max_workers=8, per_host_limit=4):
+    """ Run calls to WiPay concurrently in a bounded thread pool.
+
+    The callables must not access the ORM; see `send_request`.
+
+    :param list calls: The calls to run, as (item, url, callable) tuples; the callable takes no
+                       argument and the URL is used to apply the per-host concurrency limit.
+    :param int max_workers: The maximum number of threads.
+    :param int per_host_limit: The maximum number of concurrent calls to a same host.
+    :return: The (item, result, error) tuples, in the order of the calls.
+    :rtype: list
+    """
+    def _run(url, func):
+        with _get_host_semaphore(urlparse(url).netloc, per_host_limit):
+            try:
+                return func(), None
+            except Exception as error:  # noqa: BLE001 - reported to the caller.
+                return None, error
+
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+        futures = [executor.submit(_run, url, func) for _item, url, func in calls]
+        return [(call[0], *future.result()) for call, future in zip(calls, futures)]
+
+
+def drop_session(key):
+    """ Close and forget the pooled session for the given key, if any. """
+    with _sessions_lock:
+        entry = _sessions.pop(key, None)
+    if entry:
+        entry[1].close()
+
+
+def record_latency(key, duration):
+    """ Record the round-trip duration (in seconds) of a WiPay call. """
+    samples = _latencies.get(key)
+    if samples is None:
+        samples = _latencies.setdefault(key, deque(maxlen=LATENCY_SAMPLES))
+    samples.append(duration)
+
+
+def get_latency_stats(key):
+    """ Return the count, average and percentiles (in milliseconds) of the recorded timings.
+
+    :param tuple key: The (database name, provider id) the timings belong to.
+    :return: The latency statistics.
+    :rtype: dict
+    """
+    samples = sorted(_latencies.get(key, ()))
+    if not samples:
+        return {'count': 0}
+
+    def _percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    return {
+        'count': len(samples),
+        'avg': sum(samples) / len(samples) * 1000,
+        'p50': _percentile(0.5),
+        'p95': _percentile(0.95),
+        'max': samples[-1] * 1000,
+    }
+
+
+class Timer:
+    """ Context manager measuring the wall-clock duration of its block.
+
+    If a key is given, the duration is also recorded as a WiPay round-trip timing for that key.
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.duration = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self.start
+        if self.key is not None:
+            record_latency(self.key, self.duration)
+
+
+class LookupCache:
+    """ Small, thread-safe, per-worker LRU cache whose entries expire after a time-to-live. """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expiry = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Transaction ids of the recently seen WiPay references and payment ids.
+tx_lookup_cache = LookupCache()
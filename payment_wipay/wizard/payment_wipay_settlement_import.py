@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import io
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+
+class PaymentWipaySettlementImport(models.TransientModel):
+    _name = 'payment.wipay.settlement.import'
+    _description = "WiPay Settlement Report Import"
+
+    provider_id = fields.Many2one(
+        string="Provider",
+        comodel_name='payment.provider',
+        domain=[('code', '=', 'wipay')],
+        required=True,
+        default=lambda self: self._default_provider_id(),
+    )
+    report_file = fields.Binary(string="Settlement Report", required=True, attachment=False)
+    filename = fields.Char(string="File Name")
+    date_from = fields.Date(
+        string="Period Start",
+        help="Set the settlement period to flag the confirmed payments missing from the report",
+    )
+    date_to = fields.Date(string="Period End")
+
+    @api.model
+    def _default_provider_id(self):
+        if self.env.context.get('active_model') == 'payment.provider':
+            return self.env.context.get('active_id')
+        return self.env['payment.provider'].search([('code', '=', 'wipay')], limit=1).id
+
+    def action_import(self):
+        """ Import the report and open the discrepancies found. """
+        self.ensure_one()
+        if bool(self.date_from) != bool(self.date_to) or (
+            self.date_from and self.date_from > self.date_to
+        ):
+            raise UserError(_("Set both the start and the end of the settlement period, in order."))
+        file_format = (self.filename or '').rsplit('.', 1)[-1].lower()
+        if file_format not in ('csv', 'json', 'jsonl'):
+            raise UserError(_("The settlement report must be a CSV or JSON file."))
+
+        report_name = self.filename
+        stream = io.TextIOWrapper(
+            io.BytesIO(base64.b64decode(self.report_file)), encoding='utf-8-sig', newline=''
+        )
+        self.env['payment.wipay.settlement.discrepancy'].sudo()._import_settlement(
+            self.provider_id,
+            stream,
+            'csv' if file_format == 'csv' else 'json',
+            report_name,
+            date_from=self.date_from,
+            date_to=self.date_to,
+        )
+        action = self.env['ir.actions.actions']._for_xml_id(
+            'payment_wipay.action_payment_wipay_settlement_discrepancy'
+        )
+        action['domain'] = [('report_name', '=', report_name)]
+        return action